@@ -0,0 +1,333 @@
+# ==========================================
+# 多文件流式打包下载 (On-the-fly Zip Streaming)
+# ==========================================
+"""
+客户端想取回一批已上传的文件时，要么逐个下载，要么服务端先在磁盘上生成一个 zip 再返回
+（多一倍磁盘 I/O，还需要额外的临时空间）。
+
+这里改为边读边打包：
+- 依次读取 STORAGE_DIR 中的文件，现场拼出 zip 的本地文件头 / 数据 / 数据描述符，
+  最后输出中央目录，全程不生成临时文件
+- DEFLATE 条目的压缩后大小要压完才知道，只能把 CRC 和大小放在数据之后的数据描述符里（标志位 bit 3）；
+  STORED 条目则先在线程池里把文件读一遍算出 CRC，直接写进本地文件头，不带数据描述符。
+  因为“未压缩 + 数据描述符”的条目无法确定数据在哪里结束，只靠本地文件头顺序解析的工具
+  （包括本服务自己的 /archive-upload/）会拒绝它；代价是这类文件要多读一遍磁盘
+- 每次只在内存里保留一个 1MB 的数据块，内存占用与文件数量、文件大小无关
+- 通过 StreamingResponse 逐块发送：客户端接收慢时，发送会在 await 处等待（背压），
+  服务端不会无限制地往内存里堆数据
+- jpg / png / zip / mp4 等本身已经压缩过的格式使用 STORED（不压缩），
+  避免浪费 CPU 去压缩几乎压不动的数据；其他文件使用 DEFLATE，压缩在线程池中进行，不阻塞事件循环
+- 单个文件或整个归档超过 4GB、文件数超过 65535 时自动切换为 zip64 结构
+"""
+
+import os
+import struct
+import time
+import zlib
+from pathlib import Path as LibPath
+
+import aiofiles
+from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+
+from storage_layout import load_batch, stored_path
+
+# 每次从磁盘读取的块大小
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# 已经是压缩格式的后缀：再用 deflate 压缩几乎没有收益
+PRECOMPRESSED_EXTENSIONS = {
+    "jpg", "jpeg", "png", "gif", "webp", "heic", "avif",
+    "mp3", "aac", "ogg", "flac", "mp4", "mkv", "mov", "avi", "webm",
+    "zip", "gz", "tgz", "bz2", "xz", "zst", "7z", "rar",
+    "docx", "xlsx", "pptx", "pdf",
+}  # fmt: skip
+
+# zip 结构中的签名与常量
+ZIP_STORED, ZIP_DEFLATED = 0, 8
+LOCAL_HEADER_SIG = 0x04034B50
+DATA_DESCRIPTOR_SIG = 0x08074B50
+CENTRAL_DIR_SIG = 0x02014B50
+ZIP64_END_SIG = 0x06064B50
+ZIP64_LOCATOR_SIG = 0x07064B50
+END_OF_CENTRAL_DIR_SIG = 0x06054B50
+
+# 通用标志位：bit 3 = 大小和 CRC 写在数据之后，bit 11 = 文件名使用 UTF-8
+FLAG_UTF8 = 0x0800
+FLAG_DATA_DESCRIPTOR_UTF8 = 0x0808
+
+# 超过这个大小就对条目使用 zip64（与标准库 zipfile 的 ZIP64_LIMIT 一致）
+ZIP64_LIMIT = (1 << 31) - 1
+MAX_UINT32 = 0xFFFFFFFF
+MAX_UINT16 = 0xFFFF
+
+
+class DownloadRequest(BaseModel):
+    names: list[str] = Field(default_factory=list, description="要打包的存储名列表")
+    batch_id: str | None = Field(None, description="batch-upload 返回的批次号")
+
+
+def _dos_datetime(timestamp: float) -> tuple[int, int]:
+    """zip 使用 MS-DOS 格式的修改时间（精度 2 秒，最早 1980 年）"""
+    t = time.localtime(max(timestamp, 315532800))
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+def _choose_method(name: str) -> int:
+    ext = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    return ZIP_STORED if ext in PRECOMPRESSED_EXTENSIONS else ZIP_DEFLATED
+
+
+def _crc32_file(path: LibPath) -> tuple[int, int]:
+    """在线程池中执行：预先把文件读一遍，返回 (CRC32, 字节数)"""
+    crc, size = 0, 0
+    with open(path, "rb") as src:
+        while chunk := src.read(STREAM_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    return crc, size
+
+
+async def stream_zip(files: list[tuple[str, LibPath]]):
+    """
+    异步生成器：逐块产出 zip 字节流。
+    :param files: [(归档内文件名, 磁盘路径), ...]
+    """
+    offset = 0
+    central_records = []
+
+    for arcname, path in files:
+        file_stat = path.stat()
+        name_bytes = arcname.encode("utf-8")
+        method = _choose_method(arcname)
+        dos_time, dos_date = _dos_datetime(file_stat.st_mtime)
+        zip64 = file_stat.st_size > ZIP64_LIMIT
+        version = 45 if zip64 else 20
+
+        # 1. 本地文件头
+        if method == ZIP_STORED:
+            # 不压缩：先算出 CRC，大小就是文件大小，全部写在文件头里
+            flags = FLAG_UTF8
+            header_crc, header_size = await run_in_threadpool(_crc32_file, path)
+            zip64 = header_size > ZIP64_LIMIT
+            version = 45 if zip64 else 20
+        else:
+            # 压缩：CRC 和压缩后大小要等数据写完才知道，所以放到数据描述符里
+            flags = FLAG_DATA_DESCRIPTOR_UTF8
+            header_crc, header_size = 0, 0
+        extra = (
+            struct.pack("<HHQQ", 0x0001, 16, header_size, header_size) if zip64 else b""
+        )
+        local_header = struct.pack(
+            "<IHHHHHIIIHH",
+            LOCAL_HEADER_SIG,
+            version,
+            flags,
+            method,
+            dos_time,
+            dos_date,
+            header_crc,
+            MAX_UINT32 if zip64 else header_size,
+            MAX_UINT32 if zip64 else header_size,
+            len(name_bytes),
+            len(extra),
+        )
+        header_offset = offset
+        yield local_header + name_bytes + extra
+        offset += len(local_header) + len(name_bytes) + len(extra)
+
+        # 2. 文件数据：边读边算 CRC，需要时边读边压缩
+        crc, raw_size, compressed_size = 0, 0, 0
+        compressor = (
+            zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            if method == ZIP_DEFLATED
+            else None
+        )
+        async with aiofiles.open(path, "rb") as src:
+            while chunk := await src.read(STREAM_CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+                raw_size += len(chunk)
+                if compressor is not None:
+                    # 1MB 的 deflate 要几十毫秒，放在事件循环里会卡住其他请求；
+                    # zlib 压缩时会释放 GIL，交给线程池即可并行
+                    chunk = await run_in_threadpool(compressor.compress, chunk)
+                    if not chunk:
+                        continue
+                compressed_size += len(chunk)
+                yield chunk
+        if compressor is not None:
+            tail = await run_in_threadpool(compressor.flush)
+            compressed_size += len(tail)
+            yield tail
+        offset += compressed_size
+
+        if method == ZIP_STORED:
+            # 文件头已经发出去了，两次读取之间文件被改动的话，这个 zip 只能作废
+            if (crc, raw_size) != (header_crc, header_size):
+                raise RuntimeError(f"{arcname}: 打包过程中文件被修改")
+        else:
+            # 3. 数据描述符：zip64 条目的大小字段为 8 字节
+            size_format = "<IIQQ" if zip64 else "<IIII"
+            descriptor = struct.pack(
+                size_format, DATA_DESCRIPTOR_SIG, crc, compressed_size, raw_size
+            )
+            yield descriptor
+            offset += len(descriptor)
+
+        central_records.append(
+            (
+                name_bytes,
+                flags,
+                method,
+                dos_time,
+                dos_date,
+                crc,
+                compressed_size,
+                raw_size,
+                header_offset,
+                zip64,
+            )
+        )
+
+    # 4. 中央目录：解压工具靠它来列出和定位每个条目
+    central_dir_offset = offset
+    central_dir_size = 0
+    for (
+        name_bytes,
+        flags,
+        method,
+        dos_time,
+        dos_date,
+        crc,
+        compressed_size,
+        raw_size,
+        header_offset,
+        zip64,
+    ) in central_records:
+        # 超出 4 字节范围的字段写成 0xFFFFFFFF，真实值放进 zip64 扩展字段（顺序固定）
+        zip64_fields = []
+        if zip64 or raw_size >= MAX_UINT32:
+            zip64_fields += [raw_size, compressed_size]
+        if header_offset >= MAX_UINT32:
+            zip64_fields.append(header_offset)
+        extra = (
+            struct.pack(
+                f"<HH{len(zip64_fields)}Q",
+                0x0001,
+                8 * len(zip64_fields),
+                *zip64_fields,
+            )
+            if zip64_fields
+            else b""
+        )
+        sizes_in_extra = zip64 or raw_size >= MAX_UINT32
+        record = struct.pack(
+            "<IHHHHHHIIIHHHHHII",
+            CENTRAL_DIR_SIG,
+            45 if zip64_fields else 20,  # 创建者版本
+            45 if zip64_fields else 20,  # 解压所需最低版本
+            flags,
+            method,
+            dos_time,
+            dos_date,
+            crc,
+            MAX_UINT32 if sizes_in_extra else compressed_size,
+            MAX_UINT32 if sizes_in_extra else raw_size,
+            len(name_bytes),
+            len(extra),
+            0,  # 注释长度
+            0,  # 起始磁盘号
+            0,  # 内部属性
+            0o644 << 16,  # 外部属性：Unix 权限 rw-r--r--
+            min(header_offset, MAX_UINT32),
+        )
+        yield record + name_bytes + extra
+        central_dir_size += len(record) + len(name_bytes) + len(extra)
+
+    # 5. 结束记录：条目数或偏移超出范围时，先写 zip64 结束记录和定位器
+    count = len(central_records)
+    if (
+        count >= MAX_UINT16
+        or central_dir_offset >= MAX_UINT32
+        or central_dir_size >= MAX_UINT32
+    ):
+        zip64_end_offset = central_dir_offset + central_dir_size
+        yield struct.pack(
+            "<IQHHIIQQQQ",
+            ZIP64_END_SIG,
+            44,  # 本记录剩余部分的长度
+            45,
+            45,
+            0,
+            0,
+            count,
+            count,
+            central_dir_size,
+            central_dir_offset,
+        )
+        yield struct.pack("<IIQI", ZIP64_LOCATOR_SIG, 0, zip64_end_offset, 1)
+
+    yield struct.pack(
+        "<IHHHHIIH",
+        END_OF_CENTRAL_DIR_SIG,
+        0,
+        0,
+        min(count, MAX_UINT16),
+        min(count, MAX_UINT16),
+        min(central_dir_size, MAX_UINT32),
+        min(central_dir_offset, MAX_UINT32),
+        0,
+    )
+
+
+def create_download_router(storage_dir: LibPath) -> APIRouter:
+    """创建打包下载路由，按存储名从 storage_dir 中读取文件"""
+    router = APIRouter(tags=["archive"])
+
+    @router.post("/archive-download/", summary="多文件流式打包下载 (zip)")
+    async def archive_download(req: DownloadRequest):
+        """
+        【流式打包模式】
+        - 传 names（存储名列表）或 batch_id（batch-upload 返回的批次号），二者可以同时使用
+        - 返回的 zip 是边读边生成的，不会在服务器上留下临时文件
+        """
+        names = list(req.names)
+        if req.batch_id:
+            batch = load_batch(storage_dir, req.batch_id)
+            if batch is None:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND, detail="批次不存在"
+                )
+            names += batch
+
+        if not names:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="没有要下载的文件"
+            )
+
+        # 开始发送之前先确认所有文件都存在：响应头一旦发出就没法再返回 404 了
+        files, seen = [], set()
+        for name in names:
+            safe_name = os.path.basename(name)
+            if safe_name in seen:
+                continue
+            path = stored_path(storage_dir, safe_name)
+            if not path.is_file():
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"文件不存在: {safe_name}",
+                )
+            seen.add(safe_name)
+            files.append((safe_name, path))
+
+        return StreamingResponse(
+            stream_zip(files),
+            media_type="application/zip",
+            headers={"Content-Disposition": 'attachment; filename="download.zip"'},
+        )
+
+    return router
@@ -0,0 +1,469 @@
+# ==========================================
+# 归档流式上传：边接收边解压 (Streaming Archive Extraction)
+# ==========================================
+"""
+客户端要上传成千上万个小文件时，不管是一次巨大的 batch-upload 表单，
+还是几千次 upload/large 调用，每个文件都要付出表单解析 / 临时文件 / HTTP 往返的开销。
+
+这里改为：客户端把文件打成一个 tar（可带 gz / bz2 / xz 压缩）或 zip，
+直接作为请求体发送：
+
+    curl -X POST --data-binary @photos.tar.gz http://127.0.0.1:8000/archive-upload/
+
+服务端一边接收请求体，一边解析归档条目，不会先把整个归档落盘或读进内存：
+- tar：使用 tarfile 的流模式 "r|*"，自动识别压缩格式
+- zip：顺序解析每个条目的本地文件头（Local File Header），
+  不依赖文件末尾的中央目录，因此同样可以边收边解
+
+每个条目：
+- 与 fileUpload_optimize 一样，只保留 os.path.basename，绝对路径和含 '..' 的条目直接拒绝
+- 小条目先缓存在内存里，交给线程池并行写盘（最多 MAX_PARALLEL_WRITES 个同时进行）
+- 超过 ENTRY_BUFFER_LIMIT 的大条目在解析线程里直接流式写盘，保证内存占用有上限
+- 写盘时同时计算 sha256 登记到 .checksums/，供完整性巡检（scrubber.py）比对
+
+解压炸弹防护：请求体大小限制只约束压缩后的数据，几 MB 的 tar.gz / zip 解开可能有几百 GB。
+因此边解压边计数，条目数、单个条目解压后大小、所有条目解压后总大小任一超限，
+立即以 ArchiveError 终止（当前条目写了一半的文件会被删除）：
+- ARCHIVE_MAX_ENTRIES / ARCHIVE_MAX_ENTRY_SIZE / ARCHIVE_MAX_TOTAL_SIZE（环境变量，单位：个 / 字节）
+被跳过的目录、被拒绝的条目虽然不落盘，数据同样要解压读完，因此也一并计数。
+"""
+
+import hashlib
+import io
+import os
+import struct
+import tarfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path as LibPath, PurePosixPath
+
+import anyio.from_thread
+from fastapi import APIRouter, Request, status
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from storage_layout import allocate_path, delete_checksum, save_checksum
+
+# 同时在写盘的条目数上限
+MAX_PARALLEL_WRITES = 8
+
+# 单个条目在内存中缓存的上限，超过后改为直接流式写盘
+ENTRY_BUFFER_LIMIT = 4 * 1024 * 1024
+
+# 解压炸弹防护：条目数 / 单个条目解压后大小 / 解压后总大小的上限
+ARCHIVE_MAX_ENTRIES = int(os.getenv("ARCHIVE_MAX_ENTRIES", "10000"))
+ARCHIVE_MAX_ENTRY_SIZE = int(os.getenv("ARCHIVE_MAX_ENTRY_SIZE", str(1024**3)))
+ARCHIVE_MAX_TOTAL_SIZE = int(os.getenv("ARCHIVE_MAX_TOTAL_SIZE", str(8 * 1024**3)))
+
+# 从请求体读取 / 写盘时的块大小
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# zip 格式中用到的签名与压缩方法
+ZIP_STORED, ZIP_DEFLATED = 0, 8
+ZIP_LOCAL_HEADER = 0x04034B50
+ZIP_DATA_DESCRIPTOR = 0x08074B50
+ZIP_STOP_SIGNATURES = {0x02014B50, 0x06054B50, 0x06064B50}
+
+
+class ArchiveError(Exception):
+    """归档本身损坏或使用了不支持的特性，无法继续解析"""
+
+
+class _BodyReader(io.RawIOBase):
+    """
+    把异步的 request.stream() 包装成同步的文件对象，供 tarfile / zip 解析线程读取。
+    每次缓冲区空了，就通过 anyio.from_thread.run 回到事件循环取下一块数据。
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._buffer = b""
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    async def _next_chunk(self) -> bytes | None:
+        try:
+            return await self._stream.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    def readinto(self, target) -> int:
+        while not self._buffer and not self._eof:
+            chunk = anyio.from_thread.run(self._next_chunk)
+            if chunk is None:
+                self._eof = True
+            else:
+                # Starlette 在流结束前会产出一个空块，跳过即可
+                self._buffer = chunk
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class _PushbackReader:
+    """zip 解析需要“读多了再退回去”（deflate 结束后剩余的字节），这里加一层回退缓冲"""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._pending = b""
+
+    def read(self, size: int) -> bytes:
+        if self._pending:
+            data, self._pending = self._pending[:size], self._pending[size:]
+            if len(data) < size:
+                data += self._raw.read(size - len(data))
+            return data
+        return self._raw.read(size)
+
+    def read_exact(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise ArchiveError("归档数据提前结束")
+            data += chunk
+        return data
+
+    def unread(self, data: bytes):
+        self._pending = data + self._pending
+
+    def peek(self, size: int) -> bytes:
+        data = self.read(size)
+        self.unread(data)
+        return data
+
+
+class _EntryWriter:
+    """
+    负责把条目落盘：小条目缓存后提交给线程池，大条目超过缓存上限后就地流式写入。
+    所有条目的结果按出现顺序记录在 results 中。
+    """
+
+    def __init__(self, storage_dir: LibPath, pool: ThreadPoolExecutor):
+        self.storage_dir = storage_dir
+        self.pool = pool
+        self.slots = threading.BoundedSemaphore(MAX_PARALLEL_WRITES)
+        self.results = []
+        self.futures = []
+        # 已处理的条目数（包括被跳过的目录和被拒绝的条目）
+        self.entry_count = 0
+        # 已解压出的总字节数（所有条目累计，被跳过的条目也算在内）
+        self.total_size = 0
+
+    def _count_entry(self):
+        self.entry_count += 1
+        if self.entry_count > ARCHIVE_MAX_ENTRIES:
+            raise ArchiveError(f"条目数超过上限 {ARCHIVE_MAX_ENTRIES}")
+
+    def _count_bytes(self, entry: str, entry_size: int, chunk_size: int):
+        """entry_size 是当前条目已解压的累计大小（已包含 chunk_size）"""
+        self.total_size += chunk_size
+        if entry_size > ARCHIVE_MAX_ENTRY_SIZE:
+            raise ArchiveError(
+                f"{entry}: 解压后大小超过单个条目上限 {ARCHIVE_MAX_ENTRY_SIZE} 字节"
+            )
+        if self.total_size > ARCHIVE_MAX_TOTAL_SIZE:
+            raise ArchiveError(f"解压后总大小超过上限 {ARCHIVE_MAX_TOTAL_SIZE} 字节")
+
+    def _drain(self, entry: str, chunks, entry_size: int = 0):
+        """读完条目剩下的数据但不落盘；解压出的字节同样计入上限，防止借被跳过的条目绕过防护"""
+        for chunk in chunks:
+            entry_size += len(chunk)
+            self._count_bytes(entry, entry_size, len(chunk))
+
+    def skip(self, entry: str, chunks=(), reason: str | None = None):
+        """跳过条目（目录、非法路径等）；给出 reason 时在结果中记为 rejected"""
+        self._count_entry()
+        self._drain(entry, chunks)
+        if reason:
+            self.results.append({"entry": entry, "status": "rejected", "error": reason})
+
+    def write(self, entry: str, chunks):
+        """chunks 是一个逐块产出条目内容的迭代器"""
+        self._count_entry()
+        result = {"entry": entry}
+        self.results.append(result)
+
+        stored_name, dest_path = allocate_path(
+            self.storage_dir, os.path.basename(entry)
+        )
+        result["stored_name"] = stored_name
+
+        buffered, buffered_size, out_file, sha256 = [], 0, None, None
+        try:
+            for chunk in chunks:
+                buffered_size += len(chunk)
+                self._count_bytes(entry, buffered_size, len(chunk))
+                if out_file is not None:
+                    out_file.write(chunk)
+                    sha256.update(chunk)
+                    continue
+                buffered.append(chunk)
+                if buffered_size > ENTRY_BUFFER_LIMIT:
+                    # 大条目：不再缓存，直接在当前线程流式写盘，边写边算校验和
+                    sha256 = hashlib.sha256()
+                    save_checksum(self.storage_dir, stored_name, None)
+                    out_file = open(dest_path, "xb")
+                    for piece in buffered:
+                        out_file.write(piece)
+                        sha256.update(piece)
+                    buffered = []
+        except Exception as err:
+            if out_file is not None:
+                out_file.close()
+                os.remove(dest_path)
+            if sha256 is not None:
+                delete_checksum(self.storage_dir, stored_name)
+            result.update(status="failed", error=str(err))
+            if isinstance(err, ArchiveError):
+                # 归档本身坏了，后面的条目也无法定位，交给上层终止解析
+                raise
+            # 磁盘写入失败：把这个条目剩下的数据读完，继续处理下一个条目
+            self._drain(entry, chunks, buffered_size)
+            return
+
+        if out_file is not None:
+            out_file.close()
+            save_checksum(
+                self.storage_dir, stored_name, sha256.hexdigest(), buffered_size
+            )
+            result.update(status="success", size=buffered_size)
+            return
+
+        # 小条目：占用一个并发名额后交给线程池写盘；名额用完时解析线程会在这里等待
+        self.slots.acquire()
+        future = self.pool.submit(self._flush, dest_path, buffered, result)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def _flush(self, dest_path: LibPath, chunks: list[bytes], result: dict):
+        """在写盘线程池中执行：写入缓存的小条目并登记校验和"""
+        stored_name = result["stored_name"]
+        try:
+            save_checksum(self.storage_dir, stored_name, None)
+            sha256 = hashlib.sha256()
+            with open(dest_path, "xb") as out_file:
+                for chunk in chunks:
+                    out_file.write(chunk)
+                    sha256.update(chunk)
+            size = sum(len(c) for c in chunks)
+            save_checksum(self.storage_dir, stored_name, sha256.hexdigest(), size)
+            result.update(status="success", size=size)
+        except Exception as err:
+            if dest_path.exists():
+                os.remove(dest_path)
+            delete_checksum(self.storage_dir, stored_name)
+            result.update(status="failed", error=str(err))
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+
+
+def _check_entry_name(name: str) -> str | None:
+    """返回拒绝原因；合法时返回 None"""
+    path = PurePosixPath(name.replace("\\", "/"))
+    if path.is_absolute() or ".." in path.parts:
+        return "路径非法（绝对路径或包含 '..'）"
+    if not os.path.basename(name):
+        return "文件名为空"
+    return None
+
+
+def _extract_tar(reader, writer: _EntryWriter):
+    # "r|*"：纯流式读取，只能顺序访问，但不需要 seek，正好适合请求体
+    try:
+        with tarfile.open(fileobj=reader, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    # 目录、符号链接、设备文件等一律不落盘
+                    writer.skip(
+                        member.name,
+                        reason=None if member.isdir() else "仅支持普通文件",
+                    )
+                    continue
+                source = archive.extractfile(member)
+                chunks = iter(lambda: source.read(STREAM_CHUNK_SIZE), b"")
+                reason = _check_entry_name(member.name)
+                if reason:
+                    writer.skip(member.name, chunks, reason)
+                    continue
+                writer.write(member.name, chunks)
+    except (tarfile.TarError, EOFError, zlib.error) as err:
+        raise ArchiveError(f"tar 解析失败: {err}")
+
+
+def _zip_entry_chunks(
+    reader: _PushbackReader, method, size, has_descriptor, zip64, crc
+):
+    """按本地文件头的信息逐块产出条目的解压数据，并在结束时校验 CRC"""
+    actual_crc = 0
+    if method == ZIP_STORED:
+        remaining = size
+        while remaining > 0:
+            chunk = reader.read(min(remaining, STREAM_CHUNK_SIZE))
+            if not chunk:
+                raise ArchiveError("归档数据提前结束")
+            remaining -= len(chunk)
+            actual_crc = zlib.crc32(chunk, actual_crc)
+            yield chunk
+    else:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        remaining = None if has_descriptor else size
+        while not decompressor.eof:
+            # 每次最多解压出 STREAM_CHUNK_SIZE 字节，没用完的输入留在 unconsumed_tail，
+            # 否则 1MB 高压缩比的输入一次就能解出几个 GB
+            compressed = decompressor.unconsumed_tail
+            if not compressed:
+                want = (
+                    STREAM_CHUNK_SIZE
+                    if remaining is None
+                    else min(remaining, STREAM_CHUNK_SIZE)
+                )
+                compressed = reader.read(want) if want else b""
+                if remaining is not None:
+                    remaining -= len(compressed)
+            try:
+                chunk = decompressor.decompress(compressed, STREAM_CHUNK_SIZE)
+            except zlib.error as err:
+                raise ArchiveError(f"deflate 数据损坏: {err}")
+            if chunk:
+                actual_crc = zlib.crc32(chunk, actual_crc)
+                yield chunk
+            elif not compressed:
+                raise ArchiveError("deflate 数据提前结束")
+        # deflate 流结束后多读的字节属于后续结构（数据描述符或下一个条目），退回去
+        reader.unread(decompressor.unused_data)
+
+    if has_descriptor:
+        crc = _read_data_descriptor(reader, zip64)
+    if actual_crc != crc:
+        raise ArchiveError("CRC 校验失败，条目数据已损坏")
+
+
+def _read_data_descriptor(reader: _PushbackReader, zip64: bool) -> int:
+    """数据描述符：[可选签名] crc32 压缩大小 原始大小；返回 crc32"""
+    (head,) = struct.unpack("<I", reader.read_exact(4))
+    if head == ZIP_DATA_DESCRIPTOR:
+        (crc,) = struct.unpack("<I", reader.read_exact(4))
+    else:
+        crc = head
+    # 本地文件头带 zip64 扩展字段时，两个大小字段各占 8 字节，否则各占 4 字节
+    reader.read_exact(16 if zip64 else 8)
+    return crc
+
+
+def _extract_zip(reader: _PushbackReader, writer: _EntryWriter):
+    while True:
+        signature_bytes = reader.read(4)
+        if len(signature_bytes) < 4:
+            return
+        (signature,) = struct.unpack("<I", signature_bytes)
+        if signature in ZIP_STOP_SIGNATURES:
+            # 到达中央目录：所有条目都已处理完
+            return
+        if signature != ZIP_LOCAL_HEADER:
+            raise ArchiveError("不是有效的 zip 本地文件头")
+
+        _, flags, method, _, _, crc, csize, usize, name_len, extra_len = struct.unpack(
+            "<HHHHHIIIHH", reader.read_exact(26)
+        )
+        raw_name = reader.read_exact(name_len)
+        extra = reader.read_exact(extra_len)
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        has_descriptor = bool(flags & 0x08)
+
+        # zip64：真实大小放在扩展字段 0x0001 中
+        zip64 = False
+        offset = 0
+        while offset + 4 <= len(extra):
+            tag, length = struct.unpack_from("<HH", extra, offset)
+            if tag == 0x0001:
+                zip64 = True
+                if length >= 16:
+                    usize, csize = struct.unpack_from("<QQ", extra, offset + 4)
+                break
+            offset += 4 + length
+
+        if flags & 0x01:
+            raise ArchiveError(f"{name}: 不支持加密条目")
+        if method not in (ZIP_STORED, ZIP_DEFLATED):
+            raise ArchiveError(f"{name}: 不支持的压缩方法 {method}")
+        if method == ZIP_STORED and has_descriptor:
+            # 未压缩且大小写在数据之后：流式读取时无法确定条目边界
+            raise ArchiveError(f"{name}: 不支持未压缩且带数据描述符的条目")
+
+        chunks = _zip_entry_chunks(reader, method, csize, has_descriptor, zip64, crc)
+        is_dir = name.endswith("/")
+        reason = None if is_dir else _check_entry_name(name)
+        if is_dir or reason:
+            # 被跳过的条目也要把数据读完，才能定位到下一个条目
+            writer.skip(name, chunks, reason)
+            continue
+        writer.write(name, chunks)
+
+
+class _ReadOnly(io.RawIOBase):
+    """tarfile 需要标准的文件对象接口，这里把 _PushbackReader 适配一下"""
+
+    def __init__(self, reader: _PushbackReader):
+        self._reader = reader
+
+    def readable(self):
+        return True
+
+    def readinto(self, target) -> int:
+        data = self._reader.read(len(target))
+        target[: len(data)] = data
+        return len(data)
+
+
+def _extract(body: _BodyReader, storage_dir: LibPath) -> tuple[list, str | None]:
+    """在线程池中执行：识别格式并解析整个归档，返回 (条目结果, 致命错误)"""
+    reader = _PushbackReader(io.BufferedReader(body, STREAM_CHUNK_SIZE))
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_WRITES) as pool:
+        writer = _EntryWriter(storage_dir, pool)
+        error = None
+        try:
+            if reader.peek(4) == b"PK\x03\x04":
+                _extract_zip(reader, writer)
+            else:
+                _extract_tar(_ReadOnly(reader), writer)
+        except ArchiveError as err:
+            error = str(err)
+        writer.wait()
+    return writer.results, error
+
+
+def create_archive_router(storage_dir: LibPath) -> APIRouter:
+    """创建归档上传路由，解压出的文件按 storage_layout 的分片规则保存到 storage_dir"""
+    router = APIRouter(tags=["archive"])
+
+    @router.post("/archive-upload/", summary="tar / zip 归档流式上传并解压")
+    async def archive_upload(request: Request):
+        """
+        【归档模式】
+        - 请求体就是归档本身（application/octet-stream），格式自动识别
+        - 返回每个条目的处理结果：success / failed / rejected
+        """
+        body = _BodyReader(request.stream().__aiter__())
+        results, error = await run_in_threadpool(_extract, body, storage_dir)
+
+        content = {
+            "msg": "归档处理完成" if error is None else f"归档处理中断: {error}",
+            "total": len(results),
+            "succeeded": sum(r.get("status") == "success" for r in results),
+            "details": results,
+        }
+        return JSONResponse(
+            content,
+            status_code=(
+                status.HTTP_200_OK if error is None else status.HTTP_400_BAD_REQUEST
+            ),
+        )
+
+    return router
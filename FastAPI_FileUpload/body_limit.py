@@ -0,0 +1,125 @@
+# ==========================================
+# 请求体大小限制 (Early Body-size Enforcement)
+# ==========================================
+"""
+File(...) / bytes 参数本身不限制大小：客户端发几个 GB，服务端也会老老实实全部接收、
+缓冲进内存或 spool 临时文件，之后才轮到接口函数执行。
+
+BodySizeLimitMiddleware 在最外层拦截：
+1. 有 Content-Length 时，超限直接返回 413，一个字节的请求体都不读
+2. 没有 Content-Length（chunked 传输）时，边接收边计数，一旦超限：
+   - 对内层应用伪造一个 http.disconnect，让它立即停止读取
+   - 丢弃内层应用之后产生的响应，改为返回 413，并要求关闭连接
+
+用法：
+    app.add_middleware(
+        BodySizeLimitMiddleware,
+        max_body_size=4 * GB,
+        route_limits={"/upload/small": 10 * MB},
+    )
+"""
+
+import json
+import os
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# 全局默认上限，可通过环境变量覆盖
+MAX_BODY_SIZE = int(os.getenv("MAX_BODY_SIZE", str(4 * GB)))
+
+
+class BodySizeLimitMiddleware:
+    def __init__(
+        self,
+        app,
+        max_body_size: int = MAX_BODY_SIZE,
+        route_limits: dict[str, int] | None = None,
+    ):
+        """
+        :param max_body_size: 全局上限（字节）
+        :param route_limits: 按路径前缀单独设置的上限；多个前缀匹配时取最长的那个
+        """
+        self.app = app
+        self.max_body_size = max_body_size
+        # 按前缀长度倒序，保证更具体的规则优先匹配
+        self.route_limits = sorted(
+            (route_limits or {}).items(), key=lambda item: len(item[0]), reverse=True
+        )
+
+    def limit_for(self, path: str) -> int:
+        for prefix, limit in self.route_limits:
+            if path.startswith(prefix):
+                return limit
+        return self.max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        limit = self.limit_for(scope["path"])
+
+        # 1. 先看 Content-Length：超限就不必再接收请求体
+        for name, value in scope.get("headers") or []:
+            if name == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > limit:
+                    return await _send_413(send, limit)
+                break
+
+        # 2. 边接收边计数（chunked 或 Content-Length 与实际不符的情况）
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    # 让内层应用以为客户端断开了，从而停止读取请求体
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            if exceeded:
+                # 超限后内层应用产生的响应（通常是 400 / 500）全部丢弃
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded and not response_started:
+            await _send_413(send, limit)
+
+
+async def _send_413(send, limit: int):
+    body = json.dumps(
+        {"detail": f"请求体过大，上限为 {limit / MB:.0f}MB"}, ensure_ascii=False
+    ).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                # 请求体没读完，这条连接不能再复用，提示服务器和客户端关闭它
+                (b"connection", b"close"),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
@@ -6,7 +6,11 @@ from pydantic import BeforeValidator, BaseModel, Field, field_validator
 from uuid import uuid4
 import os
 
+from body_limit import MB, BodySizeLimitMiddleware
+
 app = FastAPI()
+# upload1 使用 bytes = File(...)，整个文件会读进内存，必须限制请求体大小
+app.add_middleware(BodySizeLimitMiddleware, route_limits={"/upload1/": 10 * MB})
 # 确保保存目录存在
 UPLOAD_DIR = "./data"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
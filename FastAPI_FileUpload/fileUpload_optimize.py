@@ -2,6 +2,7 @@
 # 1. 标准库导入 (Standard Library Imports)
 # ==========================================
 import os  # 用于底层操作系统交互（如删除文件、获取文件名）
+from contextlib import asynccontextmanager  # 用于定义应用的启动 / 关闭流程
 import uvicorn  # 用于启动 ASGI 服务器
 from pathlib import Path as LibPath  # 用于跨平台路径处理，起别名防止命名冲突
 from typing import Annotated  # 用于类型提示增强，使代码更符合 FastAPI 规范
@@ -12,16 +13,65 @@ from typing import Annotated  # 用于类型提示增强，使代码更符合 Fa
 import aiofiles  # 异步文件操作库，防止文件 I/O 阻塞事件循环
 from fastapi import (  # 从 FastAPI 核心包导入组件
     FastAPI,  # 核心应用对象
+    Depends,  # 用于声明路由依赖
     File,  # 用于定义文件字节流参数
     UploadFile,  # 用于定义高性能上传对象
     HTTPException,  # 用于抛出自定义 HTTP 异常
     status,  # 包含标准的 HTTP 状态码（如 400, 500）
 )
+from starlette.concurrency import run_in_threadpool  # 把阻塞的文件操作放到线程池执行
+
+# ==========================================
+# 本地模块导入 (Local Module Imports)
+# ==========================================
+# 哈希分片目录 + 唯一存储名 + 批次清单 + 校验和记录
+from storage_layout import allocate_path, record_checksum, save_batch
+from multipart_upload import MultipartSweeper, create_multipart_router  # 分片并行上传
+from openapi_cache import install_openapi_cache  # 预生成的 OpenAPI 文档
+from archive_upload import create_archive_router  # tar / zip 归档流式解压
+from archive_download import create_download_router  # 多文件流式打包下载
+from upload_tracing import TracingMiddleware, mark_body_parsed, span  # 分阶段追踪
+from body_limit import MB, BodySizeLimitMiddleware  # 请求体大小限制（413）
+from upload_jobs import JobPipeline, create_jobs_router  # 后台处理流水线
+from replication import ReplicaSet, create_replication_router  # 多副本同步写入
+from scrubber import Scrubber, create_scrub_router  # 后台完整性巡检
 
 # ==========================================
 # 3. 初始化与配置 (App Initialization & Config)
 # ==========================================
-app = FastAPI(title="Pro-FileUpload-Service")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动分片清理、后台处理流水线、副本修复与完整性巡检协程
+    # （multipart_sweeper / jobs / replicas / scrubber 在下方配置区创建，这里运行时才会用到）
+    await multipart_sweeper.start()
+    await jobs.start()
+    await replicas.start()
+    await scrubber.start()
+    yield
+    await scrubber.stop()
+    await replicas.stop()
+    await jobs.stop()
+    await multipart_sweeper.stop()
+
+
+app = FastAPI(title="Pro-FileUpload-Service", lifespan=lifespan)
+
+# 使用构建阶段导出的 OpenAPI 文档（python openapi_cache.py fileUpload_optimize:app），
+# 缓存缺失或过期时自动退回现场生成
+install_openapi_cache(app)
+
+# 分阶段追踪：按 TRACE_SAMPLE_RATE 采样，结果写入 traces/upload-traces.jsonl
+app.add_middleware(TracingMiddleware)
+
+# 请求体大小限制：后添加的中间件在最外层，超限请求在进入追踪和路由之前就被拒绝
+# - 全局上限由环境变量 MAX_BODY_SIZE 控制（默认 4GB）
+# - /upload/small 与 /image-upload/ 会把整个文件读进内存，单独设置更小的上限
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    route_limits={"/upload/small": 10 * MB, "/image-upload/": 20 * MB},
+)
 
 # 路径配置：使用绝对路径确保在不同环境下部署时行为一致
 
@@ -53,6 +103,30 @@ STORAGE_DIR.mkdir(
 # 性能配置：定义流式传输时每块的大小（1MB）
 STREAM_CHUNK_SIZE = 1024 * 1024
 
+# 挂载分片并行上传接口：/multipart/initiate -> parts -> complete
+app.include_router(create_multipart_router(STORAGE_DIR))
+# 定期清理超过 MULTIPART_TTL 没有新分片的上传任务
+multipart_sweeper = MultipartSweeper(STORAGE_DIR)
+
+# 挂载归档上传接口：/archive-upload/，一次请求上传成千上万个小文件
+app.include_router(create_archive_router(STORAGE_DIR))
+
+# 挂载打包下载接口：/archive-download/，按存储名或批次号边读边生成 zip
+app.include_router(create_download_router(STORAGE_DIR))
+
+# 后台处理流水线：校验和 / 元数据 / 缩略图，任务状态通过 /jobs/{job_id} 查询
+jobs = JobPipeline(STORAGE_DIR)
+app.include_router(create_jobs_router(jobs))
+
+# 多副本写入：环境变量 REPLICA_ROOTS 配置副本（本地目录或对等节点地址），未配置时只写主存储
+replicas = ReplicaSet(STORAGE_DIR)
+# 作为对等节点接收副本需要额外配置 REPLICA_PEER_ROOT 与 REPLICA_SECRET，否则不开放写入接口
+app.include_router(create_replication_router(replicas))
+
+# 完整性巡检：限速重算已存文件的 sha256，与上传时登记的校验和比对，进度见 /scrub/status
+scrubber = Scrubber(STORAGE_DIR)
+app.include_router(create_scrub_router(scrubber))
+
 
 # ==========================================
 # 4. 路由定义 (API Routes)
@@ -69,19 +143,28 @@ async def upload_small_file(
     - 优点：代码简单，处理速度快。
     - 缺点：大文件会导致内存溢出。
     """
-    save_path = STORAGE_DIR / "quick_save.jpg"
+    # 每次保存都分配唯一存储名，避免所有请求都写到同一个 quick_save.jpg 上
+    stored_name, save_path = allocate_path(STORAGE_DIR, "quick_save.jpg")
 
     try:
-        async with aiofiles.open(save_path, "wb") as buffer:
+        # "xb"：独占创建，万一目标已存在会直接报错而不是悄悄覆盖
+        async with aiofiles.open(save_path, "xb") as buffer:
             await buffer.write(file)
-        return {"message": "小文件保存成功"}
+        # 登记校验和，完整性巡检时用来发现静默损坏
+        await run_in_threadpool(record_checksum, STORAGE_DIR, stored_name, file)
+        return {"message": "小文件保存成功", "stored_name": stored_name}
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
         )
 
 
-@app.post("/upload/large", summary="大文件流式上传接口")
+# dependencies=[Depends(mark_body_parsed)]：请求体解析完成时打点，区分“接收 + spool”与后续处理
+@app.post(
+    "/upload/large",
+    summary="大文件流式上传接口",
+    dependencies=[Depends(mark_body_parsed)],
+)
 async def upload_large_file(file: UploadFile):
     """
     【模式 B：流式分块写入】
@@ -96,37 +179,50 @@ async def upload_large_file(file: UploadFile):
 
     # 2. 安全性：过滤掉用户可能构造的 '../' 攻击性路径
     safe_name = os.path.basename(file.filename)
-    dest_path = STORAGE_DIR / safe_name
+    # 分配唯一存储名和分片目录，同名文件并发上传也不会互相覆盖
+    stored_name, dest_path = allocate_path(STORAGE_DIR, safe_name)
 
-    try:
-        # 3. 异步分块搬运数据
-        async with aiofiles.open(dest_path, "wb") as out_file:
-            # 使用 Python 3.8+ 海象运算符精简逻辑
-            while chunk := await file.read(STREAM_CHUNK_SIZE):
-                await out_file.write(chunk)
-
-    except Exception as err:
-        # 异常回滚：如果传输中断，删除那个写了一半的损坏文件
-        if dest_path.exists():
-            os.remove(dest_path)
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"传输中断: {err}",
-        )
+    with span("upload.file", filename=safe_name) as file_span:
+        # 读 / 写各用一个累计计时器，循环结束后各生成一个子 span
+        reader = file_span.timer("upload.read")
+        writer = file_span.timer("upload.write")
+        try:
+            # 3. 异步分块搬运数据（同时分发给配置的副本，数据只读一次）
+            async with replicas.open(stored_name, dest_path) as out_file:
+                # 使用 Python 3.8+ 海象运算符精简逻辑
+                while chunk := await reader.measure(file.read(STREAM_CHUNK_SIZE)):
+                    await writer.measure(out_file.write(chunk))
 
-    finally:
-        # 4. 资源释放：关闭 UploadFile 的临时文件句柄（非常重要）
-        await file.close()
+        except Exception as err:
+            # 异常回滚：如果传输中断，删除那个写了一半的损坏文件
+            if dest_path.exists():
+                os.remove(dest_path)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"传输中断: {err}",
+            )
+
+        finally:
+            # 4. 资源释放：关闭 UploadFile 的临时文件句柄（非常重要）
+            await file.close()
+
+        with span("upload.stat"):
+            file_size = dest_path.stat().st_size
 
     return {
         "filename": safe_name,
-        "size": f"{dest_path.stat().st_size / 1024:.2f} KB",
+        "stored_name": stored_name,
+        "size": f"{file_size / 1024:.2f} KB",
         "msg": "上传成功",
     }
 
 
 # 文件流式批量上传
-@app.post("/batch-upload/", summary="批量文件流式上传接口")
+@app.post(
+    "/batch-upload/",
+    summary="批量文件流式上传接口",
+    dependencies=[Depends(mark_body_parsed)],
+)
 async def batch_upload(
     files: list[UploadFile] = File(..., description="支持同时上传多个大文件")
 ):
@@ -140,22 +236,29 @@ async def batch_upload(
     for file in files:
         # 1. 安全性处理：提取纯文件名并构建目标路径
         safe_name = os.path.basename(file.filename)
-        dest_path = STORAGE_DIR / safe_name
+        stored_name, dest_path = allocate_path(STORAGE_DIR, safe_name)
+
+        file_span = span("upload.file", filename=safe_name)
+        reader = file_span.timer("upload.read")
+        writer = file_span.timer("upload.write")
 
         try:
-            # 2. 异步流式写入
-            async with aiofiles.open(dest_path, "wb") as out_file:
-                # 循环读取：每次只读入指定大小（如 1MB）到内存
-                while chunk := await file.read(STREAM_CHUNK_SIZE):
-                    # 1. 执行读取并将结果赋值给 chunk
-                    # 2. 同时判断 chunk 是否有内容（如果为空，while 循环自动结束）
-                    await out_file.write(chunk)
-
-            # 计算文件大小（字节转为 KB）
-            file_size_kb = dest_path.stat().st_size / 1024
+            with file_span:
+                # 2. 异步流式写入（同时分发给配置的副本）
+                async with replicas.open(stored_name, dest_path) as out_file:
+                    # 循环读取：每次只读入指定大小（如 1MB）到内存
+                    while chunk := await reader.measure(file.read(STREAM_CHUNK_SIZE)):
+                        # 1. 执行读取并将结果赋值给 chunk
+                        # 2. 同时判断 chunk 是否有内容（如果为空，while 循环自动结束）
+                        await writer.measure(out_file.write(chunk))
+
+                # 计算文件大小（字节转为 KB）
+                with span("upload.stat"):
+                    file_size_kb = dest_path.stat().st_size / 1024
             results.append(
                 {
                     "filename": safe_name,
+                    "stored_name": stored_name,
                     "status": "success",
                     "size": f"{file_size_kb:.2f} KB",
                 }
@@ -173,7 +276,18 @@ async def batch_upload(
             # 3. 资源释放：必须关闭 UploadFile 对象以清理临时文件
             await file.close()
 
-    return {"msg": "批量处理完成", "total": len(files), "details": results}
+    # 记录本批次成功保存的文件，之后可以通过 /archive-download/ 按批次打包下载
+    batch_id = save_batch(
+        STORAGE_DIR,
+        [r["stored_name"] for r in results if r["status"] == "success"],
+    )
+
+    return {
+        "msg": "批量处理完成",
+        "batch_id": batch_id,
+        "total": len(files),
+        "details": results,
+    }
 
 
 # 限制上传格式：定义允许的后缀名集合（使用 set 查找效率更高）
@@ -200,15 +314,24 @@ async def image_upload(file: UploadFile):
 
     # 3. 验证通过后的保存逻辑
     safe_name = f"verified_{os.path.basename(file.filename)}"
-    dest_path = STORAGE_DIR / safe_name
+    stored_name, dest_path = allocate_path(STORAGE_DIR, safe_name)
 
-    async with aiofiles.open(dest_path, "wb") as out_file:
+    async with aiofiles.open(dest_path, "xb") as out_file:
         content = await file.read()
         await out_file.write(content)
+    await run_in_threadpool(record_checksum, STORAGE_DIR, stored_name, content)
 
     await file.close()
 
-    return {"msg": "图片校验通过并保存成功", "filename": safe_name}
+    # 4. 登记后台任务（缩略图、元数据、校验和），接口不等待处理完成
+    job_id = await jobs.submit(stored_name)
+
+    return {
+        "msg": "图片校验通过并保存成功",
+        "filename": safe_name,
+        "stored_name": stored_name,
+        "job_id": job_id,
+    }
 
 
 # ==========================================
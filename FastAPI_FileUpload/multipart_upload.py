@@ -0,0 +1,335 @@
+# ==========================================
+# 分片并行上传 (S3 Multipart 风格)
+# ==========================================
+"""
+单个 TCP 连接在高延迟链路上的吞吐是有上限的，大文件用一个请求传会很慢。
+这里模仿 S3 的 Multipart Upload，把一次上传拆成三步：
+
+    1. POST   /multipart/initiate                      -> 拿到 upload_id
+    2. PUT    /multipart/{upload_id}/parts/{part_no}   -> 客户端可以开多个连接并发上传各个分片
+    3. POST   /multipart/{upload_id}/complete          -> 服务端按顺序拼接成最终文件
+
+拼接时优先使用 os.copy_file_range（数据在内核里直接复制，不经过 Python 的 bytes 对象），
+不支持时退回 os.sendfile，再不行才用普通的读写循环。
+超过 MULTIPART_TTL 秒没有动静的分片目录由 MultipartSweeper 定期清理
+（在应用的 lifespan 中 start / stop），即使之后没有人再发起新的上传也会被清掉。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path as LibPath
+from typing import Annotated
+from uuid import uuid4
+
+import aiofiles
+from fastapi import APIRouter, Body, HTTPException, Path, Request, status
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+
+from scrubber import hash_file
+from storage_layout import delete_checksum, make_stored_name, save_checksum, shard_dir
+
+# 分片临时目录名（放在 STORAGE_DIR 下，以 . 开头，迁移工具不会处理它）
+PARTS_DIR_NAME = ".multipart"
+
+# 分片编号范围与 S3 保持一致
+MAX_PART_NUMBER = 10000
+
+# 未完成的上传超过这个秒数没有新分片，就视为被放弃
+MULTIPART_TTL = int(os.getenv("MULTIPART_TTL", str(24 * 3600)))
+
+# 两次清理扫描之间的间隔
+SWEEP_INTERVAL = 600
+
+# 流式写分片时的块大小（与 fileUpload_optimize 中的 STREAM_CHUNK_SIZE 一致）
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# 内核复制每次调用最多复制的字节数
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+logger = logging.getLogger("multipart_upload")
+
+
+class InitiateRequest(BaseModel):
+    filename: str = Field(..., min_length=1, description="客户端原始文件名")
+
+
+class CompletedPart(BaseModel):
+    part_number: int = Field(..., ge=1, le=MAX_PART_NUMBER)
+    etag: str = Field(..., description="上传分片时返回的 MD5")
+
+
+class CompleteRequest(BaseModel):
+    # 不传 parts 时，按编号顺序拼接目录里已有的全部分片
+    parts: list[CompletedPart] | None = None
+
+
+def _copy_range(src_fd: int, dst_fd: int, count: int):
+    """
+    把 src_fd 当前位置开始的 count 个字节追加到 dst_fd。
+    按 copy_file_range -> sendfile -> read/write 的顺序降级。
+    """
+    remaining = count
+    try:
+        while remaining > 0:
+            copied = os.copy_file_range(src_fd, dst_fd, min(remaining, COPY_CHUNK_SIZE))
+            if copied == 0:
+                break
+            remaining -= copied
+        return
+    except (AttributeError, OSError):
+        # AttributeError：非 Linux 平台没有 copy_file_range
+        # OSError：跨文件系统 (EXDEV)、内核太旧 (ENOSYS) 等
+        pass
+
+    try:
+        while remaining > 0:
+            sent = os.sendfile(dst_fd, src_fd, None, min(remaining, COPY_CHUNK_SIZE))
+            if sent == 0:
+                break
+            remaining -= sent
+        return
+    except (AttributeError, OSError):
+        pass
+
+    while remaining > 0:
+        chunk = os.read(src_fd, min(remaining, STREAM_CHUNK_SIZE))
+        if not chunk:
+            break
+        os.write(dst_fd, chunk)
+        remaining -= len(chunk)
+
+
+def _assemble(
+    part_paths: list[LibPath],
+    dest_path: LibPath,
+    storage_dir: LibPath,
+    stored_name: str,
+):
+    """在线程池中执行：把分片依次拼接到 dest_path，并登记校验和供完整性巡检比对"""
+    dst_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        # 独占创建成功之后才登记“正在写入”，重复 complete 不会冲掉已完成文件的记录
+        save_checksum(storage_dir, stored_name, None)
+        try:
+            for part_path in part_paths:
+                src_fd = os.open(part_path, os.O_RDONLY)
+                try:
+                    _copy_range(src_fd, dst_fd, os.fstat(src_fd).st_size)
+                finally:
+                    os.close(src_fd)
+        finally:
+            os.close(dst_fd)
+        # 拼接走的是内核零拷贝，数据不经过用户态，只能合并完成后再读一遍算 sha256
+        digest, size = hash_file(dest_path)
+        save_checksum(storage_dir, stored_name, digest, size)
+    except BaseException:
+        os.remove(dest_path)
+        delete_checksum(storage_dir, stored_name)
+        raise
+
+
+def cleanup_stale_uploads(parts_root: LibPath, ttl: int = MULTIPART_TTL) -> int:
+    """删除超过 ttl 秒没有更新的分片目录，返回清理的数量"""
+    if not parts_root.exists():
+        return 0
+    deadline = time.time() - ttl
+    removed = 0
+    for upload_dir in parts_root.iterdir():
+        # 目录的 mtime 会在新增分片文件时更新，可以代表“最后活跃时间”
+        if upload_dir.is_dir() and upload_dir.stat().st_mtime < deadline:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class MultipartSweeper:
+    """后台协程：每隔 SWEEP_INTERVAL 秒清理一次被放弃的分片目录"""
+
+    def __init__(self, storage_dir: LibPath, ttl: int = MULTIPART_TTL):
+        self.parts_root = storage_dir / PARTS_DIR_NAME
+        self.ttl = ttl
+        self.task: asyncio.Task | None = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                removed = await run_in_threadpool(
+                    cleanup_stale_uploads, self.parts_root, self.ttl
+                )
+                if removed:
+                    logger.info("已清理 %d 个过期的分片上传", removed)
+            except Exception:
+                # 单次清理失败（例如目录被并发删除）只记录，下一轮继续
+                logger.exception("清理过期分片上传失败")
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+
+def create_multipart_router(storage_dir: LibPath) -> APIRouter:
+    """
+    创建分片上传路由。
+    storage_dir 由调用方传入，最终文件会按 storage_layout 的分片规则落在其中。
+    """
+    router = APIRouter(prefix="/multipart", tags=["multipart"])
+    parts_root = storage_dir / PARTS_DIR_NAME
+
+    def upload_dir_of(upload_id: str) -> LibPath:
+        # upload_id 只允许是我们自己生成的 32 位 hex，防止路径穿越
+        if len(upload_id) != 32 or not all(c in "0123456789abcdef" for c in upload_id):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="upload_id 无效"
+            )
+        upload_dir = parts_root / upload_id
+        if not upload_dir.is_dir():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="上传任务不存在或已过期"
+            )
+        return upload_dir
+
+    @router.post("/initiate", summary="创建分片上传任务")
+    async def initiate(req: InitiateRequest):
+        upload_id = uuid4().hex
+        upload_dir = parts_root / upload_id
+        upload_dir.mkdir(parents=True)
+
+        manifest = {
+            "filename": os.path.basename(req.filename),
+            "stored_name": make_stored_name(req.filename),
+            "created": time.time(),
+        }
+        (upload_dir / "manifest.json").write_text(
+            json.dumps(manifest, ensure_ascii=False), encoding="utf-8"
+        )
+        return {"upload_id": upload_id, "stored_name": manifest["stored_name"]}
+
+    @router.put("/{upload_id}/parts/{part_number}", summary="上传单个分片")
+    async def upload_part(
+        upload_id: str,
+        part_number: Annotated[int, Path(ge=1, le=MAX_PART_NUMBER)],
+        request: Request,
+    ):
+        """
+        请求体直接就是分片的原始字节（Content-Type: application/octet-stream），
+        不走 multipart/form-data，省掉表单解析和临时文件。
+        """
+        upload_dir = upload_dir_of(upload_id)
+        part_path = upload_dir / f"{part_number:05d}.part"
+        # 先写临时文件再 rename，重传同一分片时不会出现读到一半的情况
+        tmp_path = upload_dir / f"{part_number:05d}.{uuid4().hex}.tmp"
+
+        md5 = hashlib.md5()
+        size = 0
+        try:
+            async with aiofiles.open(tmp_path, "wb") as out_file:
+                async for chunk in request.stream():
+                    md5.update(chunk)
+                    size += len(chunk)
+                    await out_file.write(chunk)
+            os.replace(tmp_path, part_path)
+        except Exception as err:
+            if tmp_path.exists():
+                os.remove(tmp_path)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"分片传输中断: {err}",
+            )
+
+        return {"part_number": part_number, "etag": md5.hexdigest(), "size": size}
+
+    @router.post("/{upload_id}/complete", summary="合并分片，完成上传")
+    async def complete(
+        upload_id: str, req: Annotated[CompleteRequest, Body()] = CompleteRequest()
+    ):
+        upload_dir = upload_dir_of(upload_id)
+        manifest = json.loads(
+            (upload_dir / "manifest.json").read_text(encoding="utf-8")
+        )
+
+        if req.parts is None:
+            part_paths = sorted(upload_dir.glob("*.part"))
+        else:
+            numbers = [p.part_number for p in req.parts]
+            if numbers != sorted(set(numbers)):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="分片编号必须严格递增且不能重复",
+                )
+            part_paths = []
+            for part in req.parts:
+                part_path = upload_dir / f"{part.part_number:05d}.part"
+                if not part_path.exists():
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"分片 {part.part_number} 不存在",
+                    )
+                part_paths.append(part_path)
+
+        if not part_paths:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="没有可合并的分片"
+            )
+
+        if req.parts is not None:
+            # 校验 etag：计算 MD5 需要读一遍数据，放到线程池里避免阻塞事件循环
+            def verify():
+                for part, part_path in zip(req.parts, part_paths):
+                    md5 = hashlib.md5()
+                    with open(part_path, "rb") as f:
+                        while chunk := f.read(STREAM_CHUNK_SIZE):
+                            md5.update(chunk)
+                    if md5.hexdigest() != part.etag:
+                        return part.part_number
+                return None
+
+            bad_part = await run_in_threadpool(verify)
+            if bad_part is not None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"分片 {bad_part} 的 etag 不匹配",
+                )
+
+        stored_name = manifest["stored_name"]
+        target_dir = shard_dir(storage_dir, stored_name)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        dest_path = target_dir / stored_name
+
+        try:
+            await run_in_threadpool(
+                _assemble, part_paths, dest_path, storage_dir, stored_name
+            )
+        except FileExistsError:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT, detail="该上传任务已经完成"
+            )
+
+        await run_in_threadpool(shutil.rmtree, upload_dir, True)
+
+        return {
+            "filename": manifest["filename"],
+            "stored_name": stored_name,
+            "parts": len(part_paths),
+            "size": f"{dest_path.stat().st_size / 1024:.2f} KB",
+            "msg": "上传成功",
+        }
+
+    @router.delete("/{upload_id}", summary="放弃分片上传")
+    async def abort(upload_id: str):
+        upload_dir = upload_dir_of(upload_id)
+        await run_in_threadpool(shutil.rmtree, upload_dir, True)
+        return {"upload_id": upload_id, "msg": "已取消"}
+
+    return router
@@ -0,0 +1,239 @@
+# ==========================================
+# OpenAPI 文档预生成与磁盘缓存 (Prebuilt OpenAPI Schema)
+# ==========================================
+"""
+FastAPI 默认在第一次访问 /docs 或 /openapi.json 时才去遍历所有路由和 Pydantic 模型，
+生成 OpenAPI 文档。路由多的时候，这一步要花几百毫秒，还会带来一次内存峰值，
+而且每个 worker 进程都要各自生成一遍。
+
+这里的做法：
+1. 构建阶段：执行导出命令，把文档序列化成 JSON 字节，并额外压缩一份 gzip，写到磁盘。
+       python openapi_cache.py fileUpload_optimize:app
+2. 运行阶段：install_openapi_cache(app) 接管 /openapi.json，直接返回磁盘上的字节，
+   客户端支持 gzip 时直接返回压缩版本，不需要再 json.dumps 或压缩。
+3. 防止文档过期：导出时记录一个“路由 + 模型指纹”，运行时如果指纹对不上
+   （比如改了接口但忘了重新导出），就退回到现场生成。
+"""
+
+import argparse
+import dataclasses
+import enum
+import gzip
+import hashlib
+import importlib
+import json
+import sys
+import typing
+from pathlib import Path as LibPath
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+from pydantic.fields import FieldInfo
+
+# 默认缓存目录（与本文件同级）
+DEFAULT_CACHE_DIR = LibPath(__file__).resolve().parent / ".openapi_cache"
+
+
+def _describe(value, seen: frozenset = frozenset()) -> str:
+    """
+    生成与进程无关的稳定描述：
+    - 函数 / 类用 模块.限定名 表示（repr 里的内存地址每个进程都不一样）
+    - Pydantic 模型展开成字段定义，字段定义再逐项展开（例如 BeforeValidator 里的校验函数）
+    - list[X] / X | None / Annotated[...] 等泛型展开参数，嵌套在里面的模型同样会被展开
+    - Enum 展开成所有成员的值
+    seen 记录正在展开的模型，遇到自引用模型时只写名字，避免无限递归
+    """
+
+    def describe(item) -> str:
+        return _describe(item, seen)
+
+    if isinstance(value, type) and issubclass(value, BaseModel):
+        name = f"{value.__module__}.{value.__qualname__}"
+        if value in seen:
+            return name
+        seen = seen | {value}
+        fields = ", ".join(
+            f"{field_name}={describe(field)}"
+            for field_name, field in value.model_fields.items()
+        )
+        return f"{name}({fields})"
+    if isinstance(value, type) and issubclass(value, enum.Enum):
+        members = ", ".join(f"{m.name}={m.value!r}" for m in value)
+        return f"{value.__module__}.{value.__qualname__}({members})"
+    origin = typing.get_origin(value)
+    if origin is not None:
+        # 参数化泛型 / Union / Annotated：来源类型 + 每个参数
+        args = ", ".join(map(describe, typing.get_args(value)))
+        return f"{describe(origin)}[{args}]"
+    if isinstance(value, FieldInfo):
+        # __repr_args__ 里的 annotation 已经被转成字符串，泛型参数里的模型展不开，单独处理
+        args = ", ".join(
+            f"{k}={describe(v)}" for k, v in value.__repr_args__() if k != "annotation"
+        )
+        return f"FieldInfo(annotation={describe(value.annotation)}, {args})"
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = (
+            sorted(map(describe, value))
+            if isinstance(value, (set, frozenset))
+            else map(describe, value)
+        )
+        return f"[{', '.join(items)}]"
+    if isinstance(value, dict):
+        return (
+            "{"
+            + ", ".join(f"{describe(k)}: {describe(v)}" for k, v in value.items())
+            + "}"
+        )
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        args = ", ".join(
+            f"{f.name}={describe(getattr(value, f.name))}"
+            for f in dataclasses.fields(value)
+        )
+        return f"{type(value).__qualname__}({args})"
+    if callable(value) and hasattr(value, "__qualname__"):
+        return f"{getattr(value, '__module__', '')}.{value.__qualname__}"
+    text = repr(value)
+    if " at 0x" in text:
+        # 没有自定义 repr 的对象，只能退回到类型名
+        return f"{type(value).__module__}.{type(value).__qualname__}"
+    return text
+
+
+def _describe_dependant(dependant) -> str:
+    """展开依赖树：Depends() 函数自己的参数也会出现在文档里"""
+    parts = [_describe(dependant.call) if dependant.call else ""]
+    for param in (
+        dependant.path_params
+        + dependant.query_params
+        + dependant.header_params
+        + dependant.cookie_params
+        + dependant.body_params
+    ):
+        parts.append(
+            f"{param.name}|{_describe(param.field_info)}|"
+            f"{_describe(param.field_info.annotation)}"
+        )
+    for sub in dependant.dependencies:
+        parts.append(f"({_describe_dependant(sub)})")
+    return ";".join(parts)
+
+
+def schema_fingerprint(app: FastAPI) -> str:
+    """
+    计算路由与模型的指纹。
+    只读取路由表和字段定义，不生成 JSON Schema，成本远低于 app.openapi()。
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{app.title}|{app.version}|{app.openapi_version}".encode())
+
+    for route in app.routes:
+        if not isinstance(route, APIRoute) or not route.include_in_schema:
+            continue
+        digest.update(
+            "|".join(
+                _describe(item)
+                for item in (
+                    route.path,
+                    sorted(route.methods),
+                    route.name,
+                    route.summary,
+                    route.description,
+                    route.response_description,
+                    route.tags,
+                    route.status_code,
+                    route.responses,
+                    route.deprecated,
+                    route.operation_id,
+                    route.endpoint,
+                    route.response_model,
+                )
+            ).encode()
+        )
+        digest.update(_describe_dependant(route.dependant).encode())
+
+    return digest.hexdigest()
+
+
+def _serialize(schema: dict) -> bytes:
+    # 与 FastAPI 的 JSONResponse 保持一致的序列化参数
+    return json.dumps(schema, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def export_schema(app: FastAPI, cache_dir: LibPath = DEFAULT_CACHE_DIR) -> str:
+    """构建阶段调用：生成文档并写入 openapi.json / openapi.json.gz / fingerprint"""
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    body = _serialize(app.openapi())
+    fingerprint = schema_fingerprint(app)
+
+    (cache_dir / "openapi.json").write_bytes(body)
+    # mtime=0 让压缩结果可复现，重复导出不会产生无意义的文件变化
+    (cache_dir / "openapi.json.gz").write_bytes(gzip.compress(body, 9, mtime=0))
+    (cache_dir / "fingerprint").write_text(fingerprint, encoding="utf-8")
+    return fingerprint
+
+
+def install_openapi_cache(app: FastAPI, cache_dir: LibPath = DEFAULT_CACHE_DIR):
+    """
+    运行阶段调用：用预生成的字节替换默认的 /openapi.json 路由。
+    第一次请求时才校验指纹并加载文件，因此可以在路由全部注册之前调用。
+    """
+    if not app.openapi_url:
+        return
+
+    # 去掉 FastAPI 自动注册的 /openapi.json 路由
+    app.router.routes = [
+        route
+        for route in app.router.routes
+        if getattr(route, "path", None) != app.openapi_url
+    ]
+
+    # 加载结果只在进程内存里保留一份：(原始字节, gzip 字节)
+    cached: dict[str, bytes] = {}
+
+    def load():
+        fingerprint_file = cache_dir / "fingerprint"
+        if fingerprint_file.exists() and fingerprint_file.read_text(
+            encoding="utf-8"
+        ) == schema_fingerprint(app):
+            cached["raw"] = (cache_dir / "openapi.json").read_bytes()
+            cached["gzip"] = (cache_dir / "openapi.json.gz").read_bytes()
+            # 让 app.openapi() 的其他调用方也能复用，不再重新生成
+            app.openapi_schema = json.loads(cached["raw"])
+        else:
+            # 缓存缺失或已过期：退回现场生成，并在内存中补一份压缩结果
+            cached["raw"] = _serialize(app.openapi())
+            cached["gzip"] = gzip.compress(cached["raw"], 6, mtime=0)
+
+    async def openapi(request: Request) -> Response:
+        if not cached:
+            load()
+        headers = {"Vary": "Accept-Encoding"}
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            return Response(
+                cached["gzip"], media_type="application/json", headers=headers
+            )
+        return Response(cached["raw"], media_type="application/json", headers=headers)
+
+    app.add_route(app.openapi_url, openapi, include_in_schema=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="预生成 OpenAPI 文档并写入缓存目录")
+    parser.add_argument(
+        "target", help="应用位置，格式为 模块名:变量名，例如 fileUpload_optimize:app"
+    )
+    parser.add_argument(
+        "--out", type=LibPath, default=DEFAULT_CACHE_DIR, help="缓存目录"
+    )
+    args = parser.parse_args()
+
+    # 与 uvicorn 一样，从当前工作目录导入模块
+    sys.path.insert(0, ".")
+    module_name, _, attr = args.target.partition(":")
+    target_app = getattr(importlib.import_module(module_name), attr or "app")
+
+    print(f"指纹: {export_schema(target_app, args.out)}")
+    print(f"已写入: {args.out}")
@@ -0,0 +1,529 @@
+# ==========================================
+# 上传同步多副本写入 (Tee-style Replication)
+# ==========================================
+"""
+每个上传只写一份到 STORAGE_DIR，一块盘坏了数据就没了；事后再用 rsync 复制，
+又要把数据从磁盘重新读一遍。
+
+这里在流式写盘的循环里直接“分叉”：每读到一块数据，同时写给主存储和 N 个副本，
+数据只从请求里读一次。
+
+副本根目录通过环境变量 REPLICA_ROOTS 配置，多个副本之间用英文逗号分隔：
+- 本地目录：/mnt/disk2/uploads
+- 对等节点：http://127.0.0.1:8001 —— 另一个运行 fileUpload_optimize 的进程即可充当，
+  数据通过它的 PUT /replica/{stored_name} 接口流式写入
+  例如：REPLICA_ROOTS=/mnt/disk2/uploads,http://127.0.0.1:8001
+
+写入规则：
+- 写入法定数 WRITE_QUORUM：主存储 + 成功副本数达不到法定数时，整个上传失败；默认过半
+- 每个副本有一个独立的写协程和一个最多 REPLICA_MAX_LAG_CHUNKS 块的缓冲队列
+- REPLICA_ROOTS 中排在前面的 (法定数 - 1) 个是同步副本：队列满时上传等待它们（背压），
+  上传速度受最慢的同步副本限制，但不会因为一时落后而失败
+- 其余的是异步副本：不拖慢主流程，落后超过 REPLICA_MAX_LAG_CHUNKS 块就被摘除（dropped），稍后修复
+- 没跟上或写失败的副本记录为“待修复”，由后台修复协程从主存储复制过去
+- GET /replication/metrics 查看每个副本的字节数、失败数、落后情况和待修复数量
+
+作为对等节点（接收其他节点的副本）时，需要同时配置：
+- REPLICA_PEER_ROOT：副本数据的存放目录，与本节点自己的 STORAGE_DIR 分开
+- REPLICA_SECRET：共享密钥，发送方与接收方必须一致，通过 X-Replica-Token 请求头校验
+两者缺一时不挂载 PUT / DELETE /replica/{stored_name}，任何人都无法通过它写入或删除文件
+"""
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import time
+from pathlib import Path as LibPath
+from typing import Annotated
+from urllib.parse import quote
+
+import aiofiles
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+
+from storage_layout import delete_checksum, save_checksum, stored_path
+
+REPLICA_ROOTS = [
+    r.strip() for r in os.getenv("REPLICA_ROOTS", "").split(",") if r.strip()
+]
+
+# 对等节点模式：接收到的副本数据存放目录，以及节点之间的共享密钥
+REPLICA_PEER_ROOT = os.getenv("REPLICA_PEER_ROOT", "")
+REPLICA_SECRET = os.getenv("REPLICA_SECRET", "")
+REPLICA_TOKEN_HEADER = "X-Replica-Token"
+
+# 法定写入份数（含主存储）；默认过半
+WRITE_QUORUM = int(os.getenv("WRITE_QUORUM", "0")) or None
+
+# 单个副本允许落后的最大块数，超过后被摘除
+REPLICA_MAX_LAG_CHUNKS = 8
+
+# 收尾时等待副本写完的最长秒数
+REPLICA_TIMEOUT = 30
+
+# 修复协程的巡检间隔
+REPAIR_INTERVAL = 60
+
+# 待修复记录目录（在主存储下，以 . 开头，迁移工具不会处理）
+REPAIRS_DIR_NAME = ".replication"
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger("replication")
+
+
+class ReplicationError(Exception):
+    """成功写入的份数达不到法定数"""
+
+
+class ReplicaMetrics:
+    def __init__(self):
+        self.bytes_written = 0
+        self.files_ok = 0
+        self.files_failed = 0
+        self.dropped = 0
+        self.max_lag_chunks = 0
+        self.repaired = 0
+        self.last_error = None
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+# ==========================================
+# 副本类型：本地目录 / 对等节点
+# ==========================================
+
+
+class LocalReplica:
+    """写到另一个本地目录（通常挂载在另一块盘上），目录结构与主存储相同"""
+
+    def __init__(self, root: str):
+        self.root = LibPath(root)
+        self.name = root
+
+    async def open(self, stored_name: str):
+        target = stored_path(self.root, stored_name)
+        await run_in_threadpool(target.parent.mkdir, parents=True, exist_ok=True)
+        return _LocalSink(target)
+
+    async def delete(self, stored_name: str):
+        target = stored_path(self.root, stored_name)
+        await run_in_threadpool(target.unlink, True)
+
+
+class _LocalSink:
+    def __init__(self, target: LibPath):
+        self.target = target
+        # 先写 .part，全部写完再改名，读取方永远看不到写了一半的副本
+        self.tmp = target.with_name(target.name + ".part")
+        self.file = None
+
+    async def write(self, chunk: bytes):
+        if self.file is None:
+            self.file = await aiofiles.open(self.tmp, "wb")
+        await self.file.write(chunk)
+
+    async def commit(self):
+        if self.file is None:
+            self.file = await aiofiles.open(self.tmp, "wb")
+        await self.file.close()
+        os.replace(self.tmp, self.target)
+
+    async def abort(self):
+        if self.file is not None:
+            await self.file.close()
+        if self.tmp.exists():
+            os.remove(self.tmp)
+
+
+class PeerReplica:
+    """写到另一个服务实例的 PUT /replica/{stored_name}，请求体边产生边发送"""
+
+    def __init__(self, base_url: str):
+        import httpx  # 只有配置了对等节点时才需要
+
+        self.name = base_url
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=REPLICA_TIMEOUT,
+            headers={REPLICA_TOKEN_HEADER: REPLICA_SECRET},
+        )
+
+    async def open(self, stored_name: str):
+        # 存储名保留了客户端原始文件名，可能含 ?、#、% 等字符，必须整体转义成一个路径段
+        return _PeerSink(self.client, f"/replica/{quote(stored_name, safe='')}")
+
+    async def delete(self, stored_name: str):
+        await self.client.delete(f"/replica/{quote(stored_name, safe='')}")
+
+
+class _PeerSink:
+    def __init__(self, client, url: str):
+        self.chunks: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self.request = asyncio.create_task(client.put(url, content=self._body()))
+
+    async def _body(self):
+        while (chunk := await self.chunks.get()) is not None:
+            yield chunk
+
+    async def write(self, chunk: bytes):
+        # 请求已经失败时，不要一直等在队列上
+        if self.request.done():
+            self.request.result().raise_for_status()
+        await self.chunks.put(chunk)
+
+    async def commit(self):
+        await self.chunks.put(None)
+        response = await self.request
+        response.raise_for_status()
+
+    async def abort(self):
+        self.request.cancel()
+
+
+def make_replica(root: str):
+    if root.startswith(("http://", "https://")):
+        return PeerReplica(root)
+    return LocalReplica(root)
+
+
+# ==========================================
+# 单次上传的多副本写入
+# ==========================================
+
+
+class _ReplicaStream:
+    """
+    一个副本在一次上传中的写协程 + 缓冲队列。
+    required=True 的是同步副本：队列满时等待（背压）而不是摘除。
+    """
+
+    def __init__(
+        self, replica, metrics: ReplicaMetrics, stored_name: str, required: bool
+    ):
+        self.replica = replica
+        self.metrics = metrics
+        self.required = required
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=REPLICA_MAX_LAG_CHUNKS)
+        self.task = asyncio.create_task(self._run(stored_name))
+        self.dropped = False
+
+    async def _run(self, stored_name: str):
+        sink = None
+        try:
+            sink = await self.replica.open(stored_name)
+            while (chunk := await self.queue.get()) is not None:
+                await sink.write(chunk)
+                self.metrics.bytes_written += len(chunk)
+            await sink.commit()
+        except BaseException:
+            if sink is not None:
+                await sink.abort()
+            # 清空队列，唤醒可能正在等待放入数据的上传协程
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            raise
+
+    def _drop(self):
+        self.dropped = True
+        self.metrics.dropped += 1
+        self.task.cancel()
+
+    async def feed(self, chunk: bytes):
+        if self.dropped or self.task.done():
+            return
+        if self.required:
+            try:
+                # 同步副本：等它腾出空位，上传随之放慢
+                await asyncio.wait_for(self.queue.put(chunk), REPLICA_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.metrics.last_error = "等待副本写入超时"
+                self._drop()
+                return
+        else:
+            try:
+                self.queue.put_nowait(chunk)
+            except asyncio.QueueFull:
+                # 异步副本落后太多：摘除，不让它拖慢整个上传
+                self._drop()
+                return
+        self.metrics.max_lag_chunks = max(
+            self.metrics.max_lag_chunks, self.queue.qsize()
+        )
+
+    async def finish(self) -> bool:
+        """等待副本写完，返回是否成功"""
+        if not self.dropped and not self.task.done():
+            try:
+                await asyncio.wait_for(self.queue.put(None), REPLICA_TIMEOUT)
+                await asyncio.wait_for(asyncio.shield(self.task), REPLICA_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.task.cancel()
+                self.metrics.last_error = "等待副本写入超时"
+            except Exception:
+                # 副本任务本身的异常在下面统一记录
+                pass
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            return False
+        except Exception as err:
+            self.metrics.last_error = f"{type(err).__name__}: {err}"
+            return False
+        return not self.dropped
+
+
+class ReplicatedFile:
+    """
+    异步上下文管理器：write() 写主存储的同时把数据块分发给各个副本。
+    正常退出时检查法定数，不满足则抛出 ReplicationError；异常退出时丢弃所有副本。
+    写入的同时计算 sha256，成功后登记到校验和记录中，供完整性巡检比对。
+    """
+
+    def __init__(self, replica_set: "ReplicaSet", stored_name: str, dest_path):
+        self.replica_set = replica_set
+        self.stored_name = stored_name
+        self.dest_path = dest_path
+        self.primary = None
+        self.streams: list[_ReplicaStream] = []
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    async def __aenter__(self):
+        storage_dir = self.replica_set.storage_dir
+        await run_in_threadpool(save_checksum, storage_dir, self.stored_name, None)
+        self.primary = await aiofiles.open(self.dest_path, "xb")
+        # 排在前面的 (法定数 - 1) 个副本是同步副本
+        required = self.replica_set.quorum - 1
+        self.streams = [
+            _ReplicaStream(replica, metrics, self.stored_name, index < required)
+            for index, (replica, metrics) in enumerate(self.replica_set.replicas)
+        ]
+        return self
+
+    async def write(self, chunk: bytes) -> int:
+        for stream in self.streams:
+            await stream.feed(chunk)
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+        return await self.primary.write(chunk)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.primary.close()
+        storage_dir = self.replica_set.storage_dir
+        if exc_type is not None:
+            await run_in_threadpool(delete_checksum, storage_dir, self.stored_name)
+            for stream in self.streams:
+                stream.task.cancel()
+            await asyncio.gather(
+                *(s.task for s in self.streams), return_exceptions=True
+            )
+            return False
+
+        results = [await stream.finish() for stream in self.streams]
+        for stream, ok in zip(self.streams, results):
+            if ok:
+                stream.metrics.files_ok += 1
+            else:
+                stream.metrics.files_failed += 1
+
+        acked = 1 + sum(results)
+        if acked < self.replica_set.quorum:
+            # 达不到法定数：这次上传整体失败，已写成功的副本也要删掉
+            for stream, ok in zip(self.streams, results):
+                if ok:
+                    await stream.replica.delete(self.stored_name)
+            await run_in_threadpool(delete_checksum, storage_dir, self.stored_name)
+            raise ReplicationError(
+                f"仅写入 {acked} 份，未达到法定数 {self.replica_set.quorum}"
+            )
+
+        await run_in_threadpool(
+            save_checksum,
+            storage_dir,
+            self.stored_name,
+            self.sha256.hexdigest(),
+            self.size,
+        )
+
+        # 达到法定数但有副本没跟上：记下来，由修复协程从主存储补齐
+        for index, ok in enumerate(results):
+            if not ok:
+                await run_in_threadpool(
+                    self.replica_set.mark_for_repair, index, self.stored_name
+                )
+        return False
+
+
+class ReplicaSet:
+    def __init__(
+        self,
+        storage_dir: LibPath,
+        roots: list[str] = REPLICA_ROOTS,
+        quorum: int | None = WRITE_QUORUM,
+    ):
+        self.storage_dir = storage_dir
+        self.replicas = [(make_replica(root), ReplicaMetrics()) for root in roots]
+        copies = 1 + len(self.replicas)
+        self.quorum = min(quorum or copies // 2 + 1, copies)
+        self.repairs_dir = storage_dir / REPAIRS_DIR_NAME
+        self.repair_task: asyncio.Task | None = None
+
+    def open(self, stored_name: str, dest_path: LibPath) -> ReplicatedFile:
+        return ReplicatedFile(self, stored_name, dest_path)
+
+    # ---------- 修复 ----------
+
+    def _repair_dir(self, index: int) -> LibPath:
+        # 用副本地址的哈希做目录名，配置顺序调整后记录仍然能对上
+        name = self.replicas[index][0].name
+        return self.repairs_dir / hashlib.sha1(name.encode()).hexdigest()[:12]
+
+    def mark_for_repair(self, index: int, stored_name: str):
+        repair_dir = self._repair_dir(index)
+        repair_dir.mkdir(parents=True, exist_ok=True)
+        (repair_dir / stored_name).touch()
+
+    def pending_repairs(self, index: int) -> list[str]:
+        repair_dir = self._repair_dir(index)
+        if not repair_dir.is_dir():
+            return []
+        return [p.name for p in repair_dir.iterdir()]
+
+    async def repair_once(self) -> int:
+        """把所有待修复的文件从主存储重新复制到对应副本，返回修复成功的数量"""
+        repaired = 0
+        for index, (replica, metrics) in enumerate(self.replicas):
+            names = await run_in_threadpool(self.pending_repairs, index)
+            for stored_name in names:
+                source = stored_path(self.storage_dir, stored_name)
+                marker = self._repair_dir(index) / stored_name
+                if not source.exists():
+                    # 主存储里已经没有这个文件了（例如被删除），不需要修复
+                    await run_in_threadpool(marker.unlink, True)
+                    continue
+                sink = None
+                try:
+                    sink = await replica.open(stored_name)
+                    async with aiofiles.open(source, "rb") as src:
+                        while chunk := await src.read(COPY_CHUNK_SIZE):
+                            await sink.write(chunk)
+                    await sink.commit()
+                except Exception as err:
+                    if sink is not None:
+                        await sink.abort()
+                    metrics.last_error = f"修复失败 {stored_name}: {err}"
+                    continue
+                await run_in_threadpool(marker.unlink, True)
+                metrics.repaired += 1
+                repaired += 1
+        return repaired
+
+    async def _repair_loop(self):
+        while True:
+            try:
+                await self.repair_once()
+            except Exception:
+                # 单次修复出错不能让修复协程退出，记录后等下一轮再试
+                logger.exception("副本修复失败")
+            await asyncio.sleep(REPAIR_INTERVAL)
+
+    async def start(self):
+        if self.replicas:
+            self.repair_task = asyncio.create_task(self._repair_loop())
+
+    async def stop(self):
+        if self.repair_task is not None:
+            self.repair_task.cancel()
+            await asyncio.gather(self.repair_task, return_exceptions=True)
+            self.repair_task = None
+
+    def metrics(self) -> dict:
+        return {
+            "quorum": self.quorum,
+            "copies": 1 + len(self.replicas),
+            "replicas": [
+                {
+                    "root": replica.name,
+                    **metrics.as_dict(),
+                    "pending_repairs": len(self.pending_repairs(index)),
+                }
+                for index, (replica, metrics) in enumerate(self.replicas)
+            ],
+            "time": time.time(),
+        }
+
+
+# ==========================================
+# 路由：副本指标 / 修复 / 对等节点接收端
+# ==========================================
+
+
+def create_replication_router(
+    replica_set: ReplicaSet,
+    peer_root: str = REPLICA_PEER_ROOT,
+    secret: str = REPLICA_SECRET,
+) -> APIRouter:
+    router = APIRouter(tags=["replication"])
+
+    @router.get("/replication/metrics", summary="查看各副本的写入与落后情况")
+    async def replication_metrics():
+        return await run_in_threadpool(replica_set.metrics)
+
+    @router.post("/replication/repair", summary="立即修复落后的副本")
+    async def replication_repair():
+        return {"repaired": await replica_set.repair_once()}
+
+    # 没有配置成对等节点时，不提供任何写入 / 删除入口
+    if not (peer_root and secret):
+        return router
+    peer_dir = LibPath(peer_root)
+
+    async def verify_token(
+        token: Annotated[str, Header(alias=REPLICA_TOKEN_HEADER)] = "",
+    ):
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN, detail="副本令牌无效"
+            )
+
+    @router.put(
+        "/replica/{stored_name}",
+        summary="对等节点：接收副本数据",
+        dependencies=[Depends(verify_token)],
+    )
+    async def receive_replica(stored_name: str, request: Request):
+        """作为其他节点的副本时使用：请求体就是文件原始字节"""
+        safe_name = os.path.basename(stored_name)
+        target = stored_path(peer_dir, safe_name)
+        await run_in_threadpool(target.parent.mkdir, parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + ".part")
+        size = 0
+        try:
+            async with aiofiles.open(tmp, "wb") as out_file:
+                async for chunk in request.stream():
+                    size += await out_file.write(chunk)
+            os.replace(tmp, target)
+        except Exception as err:
+            if tmp.exists():
+                os.remove(tmp)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"副本写入失败: {err}",
+            )
+        return {"stored_name": safe_name, "size": size}
+
+    @router.delete(
+        "/replica/{stored_name}",
+        summary="对等节点：删除副本",
+        dependencies=[Depends(verify_token)],
+    )
+    async def delete_replica(stored_name: str):
+        target = stored_path(peer_dir, os.path.basename(stored_name))
+        await run_in_threadpool(target.unlink, True)
+        return {"stored_name": stored_name, "msg": "已删除"}
+
+    return router
@@ -0,0 +1,426 @@
+# ==========================================
+# 存储完整性巡检 (Background Integrity Scrubber)
+# ==========================================
+"""
+磁盘静默损坏、写盘途中进程崩溃留下的半截文件，在被下载之前都不会有人发现。
+巡检协程在后台把 STORAGE_DIR 下的文件逐个重新计算 sha256，与上传时登记的校验和比对。
+
+- 校验和来源：上传接口写盘时边写边算，登记在 .checksums/ 下（见 storage_layout.save_checksum）
+  开始写之前会先登记一条“正在写入”的记录，崩溃留下的残缺文件因此能被识别出来
+- 读取方式：mmap 映射整个文件，按 MMAP_SLICE_SIZE 切片交给 hashlib，
+  不经过用户态缓冲区拷贝；hashlib 计算时会释放 GIL，所以线程池就能多核并行
+- 限速：所有工作线程共享一个令牌桶，合计读取速度不超过 SCRUB_MAX_MB_PER_SEC，
+  避免和正在进行的上传抢磁盘带宽
+- 检查点：按固定的字典序遍历，每处理完一批就把进度写入 .scrub/state.json，
+  进程重启后从上次的位置继续，而不是从头再来
+- 发现问题：追加到 .scrub/mismatches.jsonl；SCRUB_QUARANTINE=1 时把文件移入 .quarantine/
+
+查询：
+    GET  /scrub/status       当前这一轮的进度与统计
+    GET  /scrub/mismatches   最近发现的问题文件
+    POST /scrub/run          不等间隔，立即开始新一轮
+                             （当前一轮还在进行时不生效，返回 started=false）
+
+离线执行一轮（与服务共用检查点，中途 Ctrl-C 后再次执行会接着跑）：
+    python scrubber.py --root ./uploads --workers 4 --rate 200
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path as LibPath
+
+from fastapi import APIRouter
+from starlette.concurrency import run_in_threadpool
+
+from storage_layout import load_checksum
+
+# 并行计算哈希的线程数
+SCRUB_WORKERS = int(os.getenv("SCRUB_WORKERS", "2"))
+
+# 读取速度上限（MB/s），0 表示不限速
+SCRUB_MAX_MB_PER_SEC = int(os.getenv("SCRUB_MAX_MB_PER_SEC", "50"))
+
+# 两轮完整巡检之间的间隔（秒），默认一天
+SCRUB_INTERVAL = int(os.getenv("SCRUB_INTERVAL", str(24 * 3600)))
+
+# 是否把校验失败的文件移入隔离目录；默认只记录
+SCRUB_QUARANTINE = os.getenv("SCRUB_QUARANTINE", "0") == "1"
+
+# 每批处理的文件数：一批结束才写一次检查点
+SCRUB_BATCH_SIZE = 64
+
+# “正在写入”的记录超过这个时间（且文件也没有再被修改）就视为写入中断的残缺文件
+SCRUB_WRITING_GRACE = 3600
+
+# 巡检出错（例如检查点写入失败）后，等待多久再重试
+SCRUB_RETRY_DELAY = 60
+
+# 每次交给 hashlib 的切片大小
+MMAP_SLICE_SIZE = 8 * 1024 * 1024
+
+# 检查点 / 报告目录与隔离目录（以 . 开头，巡检和迁移工具都会跳过）
+SCRUB_DIR_NAME = ".scrub"
+QUARANTINE_DIR_NAME = ".quarantine"
+
+logger = logging.getLogger("scrubber")
+
+
+class ScrubCancelled(Exception):
+    """服务关闭时中断正在计算的哈希，本批次不写检查点，下次重新处理"""
+
+
+class RateLimiter:
+    """令牌桶：所有工作线程共享，合计读取速度不超过 rate 字节/秒"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def acquire(self, nbytes: int):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            # 先预约一段时间，再在锁外睡眠，其它线程可以接着排队
+            self.next_free = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def hash_file(
+    path, limiter: RateLimiter | None = None, cancel: threading.Event | None = None
+) -> tuple[str, int]:
+    """通过 mmap 计算文件的 sha256，返回 (十六进制摘要, 字节数)"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        # 空文件无法 mmap
+        if size == 0:
+            return sha256.hexdigest(), 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                # 提示内核顺序读取，加大预读
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mapped) as view:
+                for offset in range(0, size, MMAP_SLICE_SIZE):
+                    if cancel is not None and cancel.is_set():
+                        raise ScrubCancelled()
+                    with view[offset : offset + MMAP_SLICE_SIZE] as piece:
+                        if limiter is not None:
+                            limiter.acquire(len(piece))
+                        sha256.update(piece)
+    return sha256.hexdigest(), size
+
+
+def iter_stored_files(root: LibPath, after: tuple = (), prefix: tuple = ()):
+    """
+    按固定顺序递归遍历 root 下的文件，返回相对路径的各级名称（元组）。
+    - 跳过以 . 开头的目录和文件（.checksums / .jobs / .scrub 等）
+    - after 为上一次的检查点：排在它之前的子目录整个跳过，不再列目录
+    用元组而不是 "a/b" 字符串比较顺序，才能和逐级排序的遍历顺序保持一致
+    """
+    try:
+        with os.scandir(root.joinpath(*prefix)) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.name.startswith("."):
+            continue
+        parts = prefix + (entry.name,)
+        if entry.is_dir(follow_symlinks=False):
+            if parts < after[: len(parts)]:
+                continue
+            yield from iter_stored_files(root, after, parts)
+        elif entry.is_file(follow_symlinks=False) and parts > after:
+            yield parts
+
+
+def check_file(
+    storage_dir: LibPath,
+    path: LibPath,
+    limiter: RateLimiter | None = None,
+    cancel: threading.Event | None = None,
+) -> dict:
+    """校验单个文件，返回 {"stored_name", "status", ...}"""
+    stored_name = path.name
+    result = {"stored_name": stored_name, "path": str(path.relative_to(storage_dir))}
+    try:
+        record = load_checksum(storage_dir, stored_name)
+        if record is None:
+            # 功能上线之前保存的文件，或不经过登记的上传方式
+            return {**result, "status": "unrecorded"}
+
+        file_stat = path.stat()
+        if record["sha256"] is None:
+            last_activity = max(record["recorded"], file_stat.st_mtime)
+            if time.time() - last_activity < SCRUB_WRITING_GRACE:
+                return {**result, "status": "in_progress"}
+            return {**result, "status": "mismatch", "reason": "写入未完成"}
+
+        # 大小不同就不必再读一遍了（最常见的是被截断）
+        if file_stat.st_size != record["size"]:
+            return {
+                **result,
+                "status": "mismatch",
+                "reason": f"大小不符：登记 {record['size']}，实际 {file_stat.st_size}",
+            }
+
+        digest, size = hash_file(path, limiter, cancel)
+        if digest != record["sha256"]:
+            return {**result, "status": "mismatch", "reason": "sha256 不符"}
+        return {**result, "status": "ok", "bytes": size}
+    except FileNotFoundError:
+        # 巡检过程中文件被删除，不算错误
+        return {**result, "status": "vanished"}
+    except OSError as err:
+        return {**result, "status": "error", "reason": f"{type(err).__name__}: {err}"}
+
+
+# ==========================================
+# 巡检调度：分批执行 + 检查点
+# ==========================================
+
+
+class Scrubber:
+    def __init__(
+        self,
+        storage_dir: LibPath,
+        workers: int = SCRUB_WORKERS,
+        max_mb_per_sec: int = SCRUB_MAX_MB_PER_SEC,
+        quarantine: bool = SCRUB_QUARANTINE,
+        interval: int = SCRUB_INTERVAL,
+    ):
+        self.storage_dir = storage_dir
+        self.state_dir = storage_dir / SCRUB_DIR_NAME
+        self.state_file = self.state_dir / "state.json"
+        self.report_file = self.state_dir / "mismatches.jsonl"
+        self.quarantine_dir = storage_dir / QUARANTINE_DIR_NAME
+        self.workers = workers
+        self.max_mb_per_sec = max_mb_per_sec
+        self.limiter = RateLimiter(max_mb_per_sec * 1024 * 1024)
+        self.quarantine = quarantine
+        self.interval = interval
+        self.cancel = threading.Event()
+        self.pool: ThreadPoolExecutor | None = None
+        self.task: asyncio.Task | None = None
+        self.wake: asyncio.Event | None = None
+        # 是否处于两轮之间的等待中；只有这时 trigger() 才生效
+        self.idle = False
+        self.last_error: str | None = None
+
+    # ---------- 检查点 ----------
+
+    def load_state(self) -> dict:
+        if self.state_file.is_file():
+            return json.loads(self.state_file.read_text(encoding="utf-8"))
+        return self._new_pass(None)
+
+    def _new_pass(self, previous: dict | None) -> dict:
+        return {
+            "pass": (previous["pass"] + 1) if previous else 1,
+            "cursor": None,
+            "started": time.time(),
+            "finished": None,
+            "counts": {},
+            "bytes": 0,
+            "last_pass": (
+                {k: previous[k] for k in ("pass", "started", "finished", "counts")}
+                if previous
+                else None
+            ),
+        }
+
+    def _save_state(self, state: dict):
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_file.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+        # 先写临时文件再替换，崩溃时不会留下写了一半的检查点
+        os.replace(tmp, self.state_file)
+
+    # ---------- 执行（同步，运行在线程中） ----------
+
+    def run_batch(self, state: dict) -> bool:
+        """处理检查点之后的下一批文件并保存进度；返回这一轮是否已经结束"""
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        after = tuple(state["cursor"].split("/")) if state["cursor"] else ()
+        batch = []
+        for parts in iter_stored_files(self.storage_dir, after):
+            batch.append(parts)
+            if len(batch) >= SCRUB_BATCH_SIZE:
+                break
+
+        results = list(
+            self.pool.map(
+                lambda parts: check_file(
+                    self.storage_dir,
+                    self.storage_dir.joinpath(*parts),
+                    self.limiter,
+                    self.cancel,
+                ),
+                batch,
+            )
+        )
+        for result in results:
+            counts = state["counts"]
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+            state["bytes"] += result.get("bytes", 0)
+            if result["status"] in ("mismatch", "error"):
+                self._report(result)
+
+        if batch:
+            state["cursor"] = "/".join(batch[-1])
+        if len(batch) < SCRUB_BATCH_SIZE:
+            state["finished"] = time.time()
+        self._save_state(state)
+        return state["finished"] is not None
+
+    def _report(self, result: dict):
+        if self.quarantine and result["status"] == "mismatch":
+            source = self.storage_dir / result["path"]
+            target = self.quarantine_dir / result["stored_name"]
+            try:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(source, target)
+                result["quarantined"] = str(target.relative_to(self.storage_dir))
+            except OSError as err:
+                result["quarantine_error"] = f"{type(err).__name__}: {err}"
+        result["detected"] = time.time()
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.report_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    def run_pass(self) -> dict:
+        """执行（或继续执行）一整轮，供命令行使用"""
+        state = self.load_state()
+        if state["finished"] is not None:
+            state = self._new_pass(state)
+        while not self.run_batch(state):
+            pass
+        return state
+
+    def recent_mismatches(self, limit: int = 100) -> list[dict]:
+        if not self.report_file.is_file():
+            return []
+        with open(self.report_file, encoding="utf-8") as f:
+            return [json.loads(line) for line in deque(f, maxlen=limit)]
+
+    # ---------- 生命周期（运行在事件循环中） ----------
+
+    async def start(self):
+        self.cancel.clear()
+        self.wake = asyncio.Event()
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        # 先通知工作线程放弃当前文件，再等待线程池退出
+        self.cancel.set()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.pool is not None:
+            await run_in_threadpool(self.pool.shutdown, wait=True, cancel_futures=True)
+            self.pool = None
+
+    def trigger(self) -> bool:
+        """两轮之间等待时立即开始新一轮；当前一轮还在进行时不生效，返回 False"""
+        if self.wake is None or not self.idle:
+            return False
+        self.wake.set()
+        return True
+
+    async def _loop(self):
+        while True:
+            try:
+                await self._run_pass_async()
+            except ScrubCancelled:
+                return
+            except Exception as err:
+                # 检查点读写失败等错误：记录后稍后重试，巡检协程不能悄悄退出
+                self.last_error = f"{type(err).__name__}: {err}"
+                logger.exception("完整性巡检出错，%s 秒后重试", SCRUB_RETRY_DELAY)
+                await asyncio.sleep(SCRUB_RETRY_DELAY)
+
+    async def _run_pass_async(self):
+        state = await run_in_threadpool(self.load_state)
+        if state["finished"] is not None:
+            delay = state["finished"] + self.interval - time.time()
+            if delay > 0:
+                self.wake.clear()
+                self.idle = True
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self.idle = False
+            state = self._new_pass(state)
+        while not await run_in_threadpool(self.run_batch, state):
+            pass
+        self.last_error = None
+
+
+def create_scrub_router(scrubber: Scrubber) -> APIRouter:
+    router = APIRouter(prefix="/scrub", tags=["scrub"])
+
+    @router.get("/status", summary="完整性巡检进度")
+    async def scrub_status():
+        state = await run_in_threadpool(scrubber.load_state)
+        return {
+            **state,
+            "running": scrubber.task is not None and state["finished"] is None,
+            "workers": scrubber.workers,
+            "max_mb_per_sec": scrubber.max_mb_per_sec,
+            "quarantine": scrubber.quarantine,
+            "last_error": scrubber.last_error,
+        }
+
+    @router.get("/mismatches", summary="最近发现的损坏文件")
+    async def scrub_mismatches(limit: int = 100):
+        return await run_in_threadpool(scrubber.recent_mismatches, limit)
+
+    @router.post("/run", summary="立即开始新一轮巡检")
+    async def scrub_run():
+        if scrubber.trigger():
+            return {"started": True, "msg": "已开始新一轮巡检"}
+        return {"started": False, "msg": "当前一轮巡检仍在进行，未重新开始"}
+
+    return router
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="校验存储目录中的文件是否损坏")
+    parser.add_argument(
+        "--root",
+        type=LibPath,
+        default=LibPath(__file__).resolve().parent / "uploads",
+        help="存储根目录（默认为当前目录下的 uploads）",
+    )
+    parser.add_argument("--workers", type=int, default=SCRUB_WORKERS, help="线程数")
+    parser.add_argument(
+        "--rate", type=int, default=SCRUB_MAX_MB_PER_SEC, help="限速 MB/s，0 为不限"
+    )
+    parser.add_argument("--quarantine", action="store_true", help="隔离损坏的文件")
+    args = parser.parse_args()
+
+    scrubber = Scrubber(args.root, args.workers, args.rate, args.quarantine)
+    try:
+        final = scrubber.run_pass()
+    finally:
+        if scrubber.pool is not None:
+            scrubber.pool.shutdown()
+    print(f"第 {final['pass']} 轮完成：{final['counts']}，共校验 {final['bytes']} 字节")
+    print(f"问题文件记录在 {scrubber.report_file}")
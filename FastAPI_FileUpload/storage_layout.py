@@ -0,0 +1,220 @@
+# ==========================================
+# 存储目录分片布局 (Hash-Sharded Storage Layout)
+# ==========================================
+"""
+为什么要分片？
+- 所有文件都堆在同一个 uploads/ 目录下时，目录项达到百万级后，
+  ls、查找、创建文件都会明显变慢（目录本身就是一个越来越大的索引）。
+- 做法：对“存储名”做一次哈希，取前几段十六进制字符作为多级子目录。
+  例如 depth=2 时：uploads/3f/a9/<存储名>
+  每一级 256 个桶，两级就是 65536 个桶，单个目录里的文件数量大幅下降。
+
+为什么要唯一命名？
+- 两个客户端同时上传 a.png，旧逻辑会互相覆盖。
+- 现在每个文件保存时都会加上 uuid4 前缀：<32位hex>_a.png，原始文件名仍保留在后半段，方便人工排查。
+
+离线迁移：
+    python storage_layout.py --root ./uploads --workers 8
+    python storage_layout.py --dry-run      # 只打印计划，不移动文件
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path as LibPath
+from uuid import uuid4
+
+# 分片深度：0 表示不分片（保持旧的平铺结构），默认两级
+SHARD_DEPTH = int(os.getenv("UPLOAD_SHARD_DEPTH", "2"))
+
+# 每一级目录名使用的十六进制字符个数（2 个字符 = 256 个桶）
+SHARD_WIDTH = 2
+
+
+def make_stored_name(filename: str) -> str:
+    """
+    根据客户端文件名生成唯一的存储名。
+    - 先用 os.path.basename 过滤掉 '../' 之类的路径
+    - 再加上 uuid4 前缀，保证并发上传同名文件时不会互相覆盖
+    """
+    safe_name = os.path.basename(filename) or "unnamed"
+    return f"{uuid4().hex}_{safe_name}"
+
+
+def shard_dir(root: LibPath, stored_name: str, depth: int = SHARD_DEPTH) -> LibPath:
+    """
+    计算存储名对应的分片目录（不创建目录）。
+    使用存储名本身的哈希，因此只要知道存储名就能直接定位，无需额外索引。
+    """
+    digest = hashlib.sha1(stored_name.encode("utf-8")).hexdigest()
+    parts = [digest[i * SHARD_WIDTH : (i + 1) * SHARD_WIDTH] for i in range(depth)]
+    return root.joinpath(*parts)
+
+
+def stored_path(root: LibPath, stored_name: str, depth: int = SHARD_DEPTH) -> LibPath:
+    """根据存储名找到文件的完整路径（用于读取 / 删除已保存的文件）"""
+    return shard_dir(root, os.path.basename(stored_name), depth) / stored_name
+
+
+def allocate_path(root: LibPath, filename: str, depth: int = SHARD_DEPTH):
+    """
+    为一次新上传分配存储位置。
+    :return: (存储名, 完整路径)，分片目录会被自动创建
+    """
+    stored_name = make_stored_name(filename)
+    target_dir = shard_dir(root, stored_name, depth)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    return stored_name, target_dir / stored_name
+
+
+# ==========================================
+# 批次清单：记录一次 batch-upload 保存了哪些文件
+# ==========================================
+
+# 批次清单目录名（以 . 开头，迁移工具不会处理它）
+BATCHES_DIR_NAME = ".batches"
+
+
+def save_batch(root: LibPath, stored_names: list[str]) -> str:
+    """保存批次清单，返回 batch_id，之后可以凭它一次性打包下载整批文件"""
+    batch_id = uuid4().hex
+    batches_dir = root / BATCHES_DIR_NAME
+    batches_dir.mkdir(parents=True, exist_ok=True)
+    (batches_dir / f"{batch_id}.json").write_text(
+        json.dumps(stored_names, ensure_ascii=False), encoding="utf-8"
+    )
+    return batch_id
+
+
+def load_batch(root: LibPath, batch_id: str) -> list[str] | None:
+    """读取批次清单；batch_id 不存在时返回 None"""
+    manifest = root / BATCHES_DIR_NAME / f"{os.path.basename(batch_id)}.json"
+    if not manifest.is_file():
+        return None
+    return json.loads(manifest.read_text(encoding="utf-8"))
+
+
+# ==========================================
+# 校验和记录：上传时登记，完整性巡检（scrubber.py）时比对
+# ==========================================
+
+# 校验和目录名（以 . 开头，迁移工具和巡检都不会把它当成上传文件）
+CHECKSUMS_DIR_NAME = ".checksums"
+
+
+def _checksum_file(root: LibPath, stored_name: str) -> LibPath:
+    # 与数据文件使用同样的分片方式，避免记录文件全部堆在一个目录里
+    name = os.path.basename(stored_name)
+    return shard_dir(root / CHECKSUMS_DIR_NAME, name) / f"{name}.json"
+
+
+def save_checksum(
+    root: LibPath, stored_name: str, sha256: str | None, size: int | None = None
+):
+    """
+    登记文件的 sha256 与大小。
+    sha256 为 None 表示“正在写入”：开始写之前先登记一次，
+    进程在写入途中崩溃时，留下的残缺文件能被巡检识别出来。
+    """
+    target = _checksum_file(root, stored_name)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_suffix(".tmp")
+    tmp.write_text(
+        json.dumps({"sha256": sha256, "size": size, "recorded": time.time()}),
+        encoding="utf-8",
+    )
+    os.replace(tmp, target)
+
+
+def record_checksum(root: LibPath, stored_name: str, data: bytes):
+    """计算内存中数据的 sha256 并登记；哈希和写记录都是阻塞操作，应放在线程池中调用"""
+    save_checksum(root, stored_name, hashlib.sha256(data).hexdigest(), len(data))
+
+
+def load_checksum(root: LibPath, stored_name: str) -> dict | None:
+    """读取校验和记录；没有登记过（例如旧文件）时返回 None"""
+    target = _checksum_file(root, stored_name)
+    if not target.is_file():
+        return None
+    return json.loads(target.read_text(encoding="utf-8"))
+
+
+def delete_checksum(root: LibPath, stored_name: str):
+    _checksum_file(root, stored_name).unlink(missing_ok=True)
+
+
+# ==========================================
+# 离线迁移工具：平铺目录 -> 分片目录
+# ==========================================
+
+# 每批提交给线程池的文件数
+MIGRATE_BATCH_SIZE = 1000
+
+
+def _migrate_one(root: LibPath, entry: os.DirEntry, depth: int, dry_run: bool):
+    """迁移单个文件；同一文件系统内 os.replace 只是改目录项，不会复制数据"""
+    target = stored_path(root, entry.name, depth)
+    if target.exists():
+        # 目标位置已有同名文件（例如重复执行迁移），跳过而不是覆盖
+        return entry.name, "skipped"
+    if dry_run:
+        return entry.name, f"plan -> {target.relative_to(root)}"
+    target.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(entry.path, target)
+    return entry.name, "moved"
+
+
+def migrate_flat_dir(
+    root: LibPath, depth: int = SHARD_DEPTH, workers: int = 8, dry_run: bool = False
+):
+    """
+    把 root 顶层的所有普通文件移动到分片目录中，逐个产出 (文件名, 结果)。
+    - 只处理顶层文件，已经存在的分片子目录不会被重复处理
+    - 迁移以原文件名作为存储名，所以旧文件名仍然可以通过 stored_path 找到
+    - 使用线程池并发执行 rename，百万级文件时可显著缩短迁移时间
+    - 每次最多提交 MIGRATE_BATCH_SIZE 个任务，处理完一批再读下一批目录项，
+      内存占用与目录大小无关
+    """
+    if depth <= 0:
+        return
+
+    # os.scandir 是惰性迭代，不会一次性把百万个目录项读进内存
+    with os.scandir(root) as it, ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = [
+                pool.submit(_migrate_one, root, entry, depth, dry_run)
+                for entry in itertools.islice(
+                    (e for e in it if e.is_file(follow_symlinks=False)),
+                    MIGRATE_BATCH_SIZE,
+                )
+            ]
+            if not batch:
+                return
+            for future in batch:
+                yield future.result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把平铺的上传目录迁移为哈希分片布局")
+    parser.add_argument(
+        "--root",
+        type=LibPath,
+        default=LibPath(__file__).resolve().parent / "uploads",
+        help="存储根目录（默认为当前目录下的 uploads）",
+    )
+    parser.add_argument("--depth", type=int, default=SHARD_DEPTH, help="分片层数")
+    parser.add_argument("--workers", type=int, default=8, help="并发线程数")
+    parser.add_argument("--dry-run", action="store_true", help="只打印迁移计划")
+    args = parser.parse_args()
+
+    total = 0
+    for name, outcome in migrate_flat_dir(
+        args.root, args.depth, args.workers, args.dry_run
+    ):
+        print(f"{outcome:<10} {name}")
+        total += 1
+    print(f"共处理 {total} 个文件")
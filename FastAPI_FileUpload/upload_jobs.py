@@ -0,0 +1,358 @@
+# ==========================================
+# 上传后台处理流水线 (Background Post-processing Jobs)
+# ==========================================
+"""
+图片上传成功后，还需要：计算校验和、提取元数据、生成缩略图。
+这些都是 CPU 密集型操作，直接放在接口里做会阻塞事件循环，也会拖慢响应。
+
+流水线结构：
+    接口 submit() ──> asyncio.Queue（有界） ──> N 个调度协程 ──> ProcessPoolExecutor（多核并行）
+
+- 有界队列：队列满时任务先以 pending 状态落盘，等队列有空位后由巡检协程补充入队，
+  接口本身永远不会因为后台繁忙而阻塞
+- 重试：单个任务最多执行 JOB_MAX_RETRIES 次，失败后按指数退避重新入队
+- 持久化：任务状态以 JSON 写在 STORAGE_DIR/.jobs/ 下，进程重启后未完成的任务会被重新执行；
+  已结束（succeeded / failed）的任务移到 .jobs/done/，巡检时不再反复读取
+- 容错：调度协程和巡检协程出错只记录日志、不会退出；子进程崩溃（BrokenProcessPool，
+  例如处理恶意图片时内存耗尽）后会重建进程池，当前任务按普通失败计入重试
+- 查询：GET /jobs/{job_id}
+
+缩略图依赖 Pillow（可选）；未安装时该步骤记为 skipped，其余步骤照常执行。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path as LibPath
+from uuid import uuid4
+
+from fastapi import APIRouter, HTTPException, status
+from starlette.concurrency import run_in_threadpool
+
+from storage_layout import stored_path
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow 是可选依赖
+    Image = None
+
+# 任务状态目录名 / 缩略图目录名（以 . 开头，迁移工具不会处理）
+JOBS_DIR_NAME = ".jobs"
+DONE_DIR_NAME = "done"
+THUMBNAILS_DIR_NAME = ".thumbnails"
+
+# 队列深度上限：超过后任务只落盘，不进内存队列
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+
+# 每个任务最多尝试的次数
+JOB_MAX_RETRIES = 3
+
+# 进程池大小，默认等于 CPU 核数
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(os.cpu_count() or 1)))
+
+# 巡检间隔：把落盘但未入队的 pending 任务补进队列
+SWEEP_INTERVAL = 30
+
+# 缩略图最长边
+THUMBNAIL_SIZE = (256, 256)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+FINAL_STATUSES = ("succeeded", "failed")
+
+logger = logging.getLogger("upload_jobs")
+
+
+# ==========================================
+# 在子进程中执行的处理步骤（必须是模块级函数，才能被 pickle 传给子进程）
+# ==========================================
+
+
+def compute_checksum(path: str) -> dict:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha256.update(chunk)
+    return {"sha256": sha256.hexdigest()}
+
+
+def extract_metadata(path: str) -> dict:
+    """读取文件头获取图片尺寸，只解析 PNG / GIF / JPEG，不依赖第三方库"""
+    file_stat = os.stat(path)
+    meta = {"size": file_stat.st_size, "mtime": file_stat.st_mtime}
+    with open(path, "rb") as f:
+        head = f.read(32)
+        if head.startswith(b"\x89PNG\r\n\x1a\n"):
+            meta["format"] = "png"
+            meta["width"], meta["height"] = struct.unpack(">II", head[16:24])
+        elif head[:6] in (b"GIF87a", b"GIF89a"):
+            meta["format"] = "gif"
+            meta["width"], meta["height"] = struct.unpack("<HH", head[6:10])
+        elif head.startswith(b"\xff\xd8"):
+            meta["format"] = "jpeg"
+            meta.update(_jpeg_size(f))
+    return meta
+
+
+def _jpeg_size(f) -> dict:
+    """顺序扫描 JPEG 段，找到 SOF 段读取宽高"""
+    f.seek(2)
+    while marker := f.read(2):
+        if len(marker) < 2 or marker[0] != 0xFF:
+            break
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            break
+        (length,) = struct.unpack(">H", length_bytes)
+        # SOF0 ~ SOF15（排除 DHT/JPG/DAC 这几个不是帧头的标记）
+        if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">xHH", f.read(5))
+            return {"width": width, "height": height}
+        f.seek(length - 2, os.SEEK_CUR)
+    return {}
+
+
+def make_thumbnail(path: str, thumb_path: str) -> dict:
+    if Image is None:
+        return {"skipped": "未安装 Pillow"}
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    with Image.open(path) as img:
+        img.thumbnail(THUMBNAIL_SIZE)
+        img.convert("RGB").save(thumb_path, "JPEG", quality=85)
+    return {"path": thumb_path}
+
+
+# 步骤顺序即执行顺序；重试时已经成功的步骤不会重复执行
+STEPS = ("checksum", "metadata", "thumbnail")
+
+
+# ==========================================
+# 任务调度（运行在事件循环中）
+# ==========================================
+
+
+class JobPipeline:
+    def __init__(self, storage_dir: LibPath, workers: int = JOB_WORKERS):
+        self.storage_dir = storage_dir
+        self.jobs_dir = storage_dir / JOBS_DIR_NAME
+        self.done_dir = self.jobs_dir / DONE_DIR_NAME
+        self.thumbnails_dir = storage_dir / THUMBNAILS_DIR_NAME
+        self.workers = workers
+        self.queue: asyncio.Queue | None = None
+        self.pool: ProcessPoolExecutor | None = None
+        self.tasks: list[asyncio.Task] = []
+        # 已经在内存队列中（或正在执行）的任务，巡检时跳过
+        self.enqueued: set[str] = set()
+
+    # ---------- 状态持久化 ----------
+
+    def _job_file(self, job_id: str, done: bool = False) -> LibPath:
+        return (self.done_dir if done else self.jobs_dir) / (
+            f"{os.path.basename(job_id)}.json"
+        )
+
+    def _write_state(self, job: dict):
+        job["updated"] = time.time()
+        done = job["status"] in FINAL_STATUSES
+        target = self._job_file(job["id"], done)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_suffix(".tmp")
+        tmp.write_text(json.dumps(job, ensure_ascii=False), encoding="utf-8")
+        # 先写临时文件再替换，进程崩溃时不会留下写了一半的状态文件
+        os.replace(tmp, target)
+        if done:
+            # 已结束的任务移出巡检目录
+            self._job_file(job["id"]).unlink(missing_ok=True)
+
+    async def save(self, job: dict):
+        await run_in_threadpool(self._write_state, job)
+
+    def load(self, job_id: str) -> dict | None:
+        for job_file in (self._job_file(job_id), self._job_file(job_id, done=True)):
+            if job_file.is_file():
+                return json.loads(job_file.read_text(encoding="utf-8"))
+        return None
+
+    # ---------- 生命周期 ----------
+
+    async def start(self):
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self.queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+        self.pool = self._new_pool()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self._sweeper()))
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # 事件循环进程里已经有线程在运行，fork 出的子进程可能继承到被锁住的锁；
+        # 改用 forkserver / spawn 启动干净的子进程
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn"
+        )
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    def _replace_broken_pool(self, broken: ProcessPoolExecutor):
+        # 多个调度协程可能同时发现同一个坏掉的进程池，只重建一次
+        if self.pool is broken:
+            logger.warning("后台进程池已损坏，正在重建")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.pool = self._new_pool()
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+        # 未完成的任务保持 pending / running 状态，下次启动时会被巡检协程重新入队
+
+    # ---------- 提交与调度 ----------
+
+    async def submit(self, stored_name: str) -> str:
+        """登记一个后台任务并立即返回 job_id，不等待处理完成"""
+        job = {
+            "id": uuid4().hex,
+            "stored_name": stored_name,
+            "status": "pending",
+            "attempts": 0,
+            "steps": {},
+            "error": None,
+            "created": time.time(),
+        }
+        await run_in_threadpool(self.jobs_dir.mkdir, parents=True, exist_ok=True)
+        await self.save(job)
+        self._try_enqueue(job["id"])
+        return job["id"]
+
+    def _try_enqueue(self, job_id: str) -> bool:
+        if self.queue is None or job_id in self.enqueued:
+            return False
+        try:
+            self.queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            # 队列满：任务已经落盘，等巡检协程补充入队
+            return False
+        self.enqueued.add(job_id)
+        return True
+
+    def _requeue(self, job_id: str):
+        try:
+            self.queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            # 放不进去就交还给巡检协程处理
+            self.enqueued.discard(job_id)
+
+    async def _sweeper(self):
+        """启动时立即巡检一次（恢复上次未完成的任务），之后定期巡检"""
+        while True:
+            try:
+                await self._sweep_once()
+            except Exception:
+                # 读取失败只记录，等下一轮再试，巡检协程不能退出
+                logger.exception("任务巡检失败")
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+    async def _sweep_once(self):
+        # 只扫描 .jobs/ 顶层：已结束的任务都在 done/ 子目录中
+        job_files = await run_in_threadpool(
+            lambda: sorted(self.jobs_dir.glob("*.json"))
+        )
+        for job_file in job_files:
+            if self.queue.full():
+                break
+            job_id = job_file.stem
+            if job_id in self.enqueued:
+                continue
+            job = await run_in_threadpool(self.load, job_id)
+            if job is None:
+                continue
+            if job["status"] in FINAL_STATUSES:
+                # 旧版本留在顶层的已结束任务，顺手移到 done/
+                await self.save(job)
+            else:
+                self._try_enqueue(job_id)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self._run(loop, job_id)
+            except Exception:
+                # 读写状态文件等步骤以外的错误：记录后交还给巡检协程，调度协程继续工作
+                logger.exception("后台任务 %s 调度失败", job_id)
+                self.enqueued.discard(job_id)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, loop, job_id: str):
+        job = await run_in_threadpool(self.load, job_id)
+        if job is None:
+            self.enqueued.discard(job_id)
+            return
+
+        path = str(stored_path(self.storage_dir, job["stored_name"]))
+        thumb_path = str(stored_path(self.thumbnails_dir, job["stored_name"] + ".jpg"))
+        step_calls = {
+            "checksum": (compute_checksum, path),
+            "metadata": (extract_metadata, path),
+            "thumbnail": (make_thumbnail, path, thumb_path),
+        }
+
+        job["status"] = "running"
+        job["attempts"] += 1
+        await self.save(job)
+
+        try:
+            for step in STEPS:
+                if step in job["steps"]:
+                    continue
+                func, *args = step_calls[step]
+                # CPU 密集的步骤交给进程池，事件循环只负责等待结果
+                pool = self.pool
+                try:
+                    job["steps"][step] = await loop.run_in_executor(pool, func, *args)
+                except BrokenProcessPool:
+                    self._replace_broken_pool(pool)
+                    raise
+                await self.save(job)
+        except Exception as err:
+            job["error"] = f"{type(err).__name__}: {err}"
+            if job["attempts"] < JOB_MAX_RETRIES:
+                job["status"] = "pending"
+                await self.save(job)
+                # 指数退避后重新入队；退避期间不占用调度协程，
+                # 任务仍留在 enqueued 中，避免巡检协程提前把它塞回队列
+                loop.call_later(2 ** job["attempts"], self._requeue, job_id)
+                return
+            job["status"] = "failed"
+        else:
+            job["status"] = "succeeded"
+            job["error"] = None
+
+        await self.save(job)
+        self.enqueued.discard(job_id)
+
+
+def create_jobs_router(pipeline: JobPipeline) -> APIRouter:
+    router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+    @router.get("/{job_id}", summary="查询后台任务状态")
+    async def job_status(job_id: str):
+        job = await run_in_threadpool(pipeline.load, job_id)
+        if job is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="任务不存在"
+            )
+        return job
+
+    return router
@@ -0,0 +1,377 @@
+# ==========================================
+# 上传链路分阶段追踪 (Per-stage Span Tracing)
+# ==========================================
+"""
+upload/large 或 batch-upload 变慢时，需要知道时间到底花在哪一段：
+
+    http.request                 整个请求（中间件）
+    ├── http.parse_body          接收请求体 + Starlette 解析 multipart 并写入临时文件（spool）
+    └── upload.file              单个文件的处理
+        ├── upload.read          UploadFile.read 的累计耗时与字节数
+        ├── upload.write         aiofiles 写盘的累计耗时与字节数
+        └── upload.stat          计算 size 时的 stat 调用
+
+- 追踪 ID：优先沿用请求头 traceparent（W3C Trace Context），否则新生成；响应头 X-Trace-Id 回传
+- 采样：按 TRACE_SAMPLE_RATE 随机采样；上游 traceparent 已标记采样时一律记录。
+  未采样的请求只会拿到一个空操作对象，几乎没有额外开销
+- 导出：每个 trace 一行，格式与 OTLP/JSON（ExportTraceServiceRequest）一致，
+  写入按大小轮转的本地文件，写文件放在后台线程里，不阻塞事件循环
+
+用法：
+    app.add_middleware(TracingMiddleware)
+    @app.post("/xxx", dependencies=[Depends(mark_body_parsed)])
+    ...
+    with span("upload.file", filename=name) as file_span:
+        reader = file_span.timer("upload.read")
+        while chunk := await reader.measure(file.read(SIZE)):
+            ...
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path as LibPath
+
+# 采样率：0 表示关闭，1 表示全部记录
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+
+# 导出文件：单个文件超过 TRACE_MAX_BYTES 后轮转，最多保留 TRACE_BACKUP_COUNT 个历史文件
+TRACE_FILE = LibPath(__file__).resolve().parent / "traces" / "upload-traces.jsonl"
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUP_COUNT = 5
+
+SERVICE_NAME = "Pro-FileUpload-Service"
+
+# 当前协程所处的 span；asyncio 的每个任务都有自己独立的上下文副本
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+_exporter: logging.Logger | None = None
+
+
+def _get_exporter() -> logging.Logger:
+    """第一次导出时才创建文件与后台线程；没有采样到任何请求时不会产生文件"""
+    global _exporter
+    if _exporter is None:
+        TRACE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        file_handler = RotatingFileHandler(
+            TRACE_FILE,
+            maxBytes=TRACE_MAX_BYTES,
+            backupCount=TRACE_BACKUP_COUNT,
+            encoding="utf-8",
+        )
+        # QueueHandler 只负责把记录放进队列，真正写文件由 QueueListener 的线程完成
+        records = queue.SimpleQueue()
+        listener = QueueListener(records, file_handler)
+        listener.start()
+        atexit.register(listener.stop)
+
+        logger = logging.getLogger("upload_tracing")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(QueueHandler(records))
+        _exporter = logger
+    return _exporter
+
+
+def _attribute(key: str, value) -> dict:
+    """转换成 OTLP 的属性格式"""
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Trace:
+    """一次请求内的所有 span；根 span 结束时整体导出"""
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: list[Span] = []
+        # 请求体接收阶段的统计，由中间件的 receive 包装函数累加
+        self.body_span: Span | None = None
+        self.receive_wait_ns = 0
+        self.receive_bytes = 0
+
+    def export(self):
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [_attribute("service.name", SERVICE_NAME)]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "upload_tracing"},
+                            "spans": [s.to_otlp() for s in self.spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        _get_exporter().info(json.dumps(payload, ensure_ascii=False))
+
+
+# OTLP 中的 SpanKind
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+
+
+class Span:
+    def __init__(
+        self,
+        trace: Trace,
+        name: str,
+        parent_id: str | None,
+        attributes,
+        kind: int = SPAN_KIND_INTERNAL,
+    ):
+        self.trace = trace
+        self.name = name
+        self.kind = kind
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self._timers: list[StageTimer] = []
+        self._token = None
+        trace.spans.append(self)
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def timer(self, name: str) -> "StageTimer":
+        """创建一个累计计时器：循环里的每次调用合并成一个子 span，避免 span 数量爆炸"""
+        stage = StageTimer(self, name)
+        self._timers.append(stage)
+        return stage
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        for stage in self._timers:
+            stage.flush()
+        self.end_ns = time.time_ns()
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.error = repr(exc)
+        self.end()
+        _current_span.reset(self._token)
+        return False
+
+    def to_otlp(self) -> dict:
+        data = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_attribute(k, v) for k, v in self.attributes.items()],
+            "status": (
+                {"code": 2, "message": self.error} if self.error else {"code": 1}
+            ),
+        }
+        if self.parent_id:
+            data["parentSpanId"] = self.parent_id
+        return data
+
+
+class StageTimer:
+    """
+    累计计时器：记录第一次开始到最后一次结束的区间、实际忙碌时间、调用次数和字节数，
+    在父 span 结束时生成一个子 span。
+    """
+
+    def __init__(self, parent: Span | None, name: str):
+        self.parent = parent
+        self.name = name
+        self.first_ns = None
+        self.last_ns = None
+        self.busy_ns = 0
+        self.calls = 0
+        self.bytes = 0
+
+    async def measure(self, awaitable):
+        """等待 awaitable 并计时；返回 bytes 时累加长度，返回 int 时视为写入的字节数"""
+        start = time.time_ns()
+        result = await awaitable
+        end = time.time_ns()
+        if self.first_ns is None:
+            self.first_ns = start
+        self.last_ns = end
+        self.busy_ns += end - start
+        self.calls += 1
+        if isinstance(result, (bytes, bytearray)):
+            self.bytes += len(result)
+        elif isinstance(result, int):
+            self.bytes += result
+        return result
+
+    def flush(self):
+        if self.parent is None or self.first_ns is None:
+            return
+        child = Span(
+            self.parent.trace,
+            self.name,
+            self.parent.span_id,
+            {
+                "bytes": self.bytes,
+                "calls": self.calls,
+                "busy_ms": self.busy_ns / 1e6,
+            },
+        )
+        child.start_ns, child.end_ns = self.first_ns, self.last_ns
+        self.first_ns = None
+
+
+class _NoopSpan:
+    """未采样时使用：所有操作都是空的，成本只有一次函数调用"""
+
+    def set(self, key, value):
+        pass
+
+    def timer(self, name):
+        return _NoopTimer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class _NoopTimer:
+    async def measure(self, awaitable):
+        return await awaitable
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, **attributes):
+    """在当前 span 下开启一个子 span；当前请求未被采样时返回空操作对象"""
+    parent = _current_span.get()
+    if parent is None:
+        return _NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def _parse_traceparent(header: str | None):
+    """解析 traceparent: 00-<trace_id 32hex>-<parent_id 16hex>-<flags 2hex>"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        sampled = bool(int(parts[3], 16) & 0x01)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32:
+        return None
+    return parts[1], parts[2], sampled
+
+
+class TracingMiddleware:
+    """
+    纯 ASGI 中间件：
+    - 为每个采样到的请求创建根 span，并包装 receive 统计请求体字节数和等待网络的时间
+    - 请求结束后把整个 trace 交给后台线程写文件
+    """
+
+    def __init__(self, app, sample_rate: float | None = None):
+        self.app = app
+        self.sample_rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        upstream = _parse_traceparent(headers.get(b"traceparent", b"").decode())
+        if upstream:
+            trace_id, parent_id, sampled = upstream
+            sampled = sampled or random.random() < self.sample_rate
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = random.random() < self.sample_rate
+        if not sampled:
+            return await self.app(scope, receive, send)
+
+        trace = Trace(trace_id)
+        # 有上游 traceparent 时，上游调用方的 span 作为远程父节点
+        root = Span(
+            trace,
+            "http.request",
+            parent_id,
+            {"http.method": scope["method"], "http.target": scope["path"]},
+            kind=SPAN_KIND_SERVER,
+        )
+        trace.body_span = Span(trace, "http.parse_body", root.span_id, {})
+
+        async def traced_receive():
+            start = time.monotonic_ns()
+            message = await receive()
+            trace.receive_wait_ns += time.monotonic_ns() - start
+            if message["type"] == "http.request":
+                trace.receive_bytes += len(message.get("body", b""))
+            return message
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                root.set("http.status_code", message["status"])
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"x-trace-id", trace_id.encode())
+                ]
+            await send(message)
+
+        try:
+            with root:
+                await self.app(scope, traced_receive, traced_send)
+        finally:
+            # 没有声明 mark_body_parsed 的路由无法确定解析阶段的终点，不输出这个 span
+            if trace.body_span is not None and trace.body_span.end_ns is None:
+                trace.spans.remove(trace.body_span)
+            trace.export()
+
+
+def _close_body_span(trace: Trace):
+    body_span = trace.body_span
+    if body_span is None or body_span.end_ns is not None:
+        return
+    body_span.end()
+    duration_ns = body_span.end_ns - body_span.start_ns
+    body_span.set("body.bytes", trace.receive_bytes)
+    body_span.set("receive.wait_ms", trace.receive_wait_ns / 1e6)
+    # 解析阶段中不在等网络的部分：multipart 解析 + 写入 SpooledTemporaryFile
+    body_span.set("spool.ms", max(duration_ns - trace.receive_wait_ns, 0) / 1e6)
+
+
+async def mark_body_parsed():
+    """
+    作为路由依赖使用：FastAPI 会先读取并解析完请求体，再执行依赖，
+    所以依赖被调用的时刻就是“请求体接收 + spool 完成”的时刻。
+    """
+    current = _current_span.get()
+    if current is not None:
+        _close_body_span(current.trace)
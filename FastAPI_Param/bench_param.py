@@ -0,0 +1,248 @@
+# ==========================================
+# 参数校验 / 路由开销微基准 (In-process Microbenchmark)
+# ==========================================
+"""
+不启动 uvicorn、不走网络，直接通过 httpx.ASGITransport 在进程内调用各个 app，
+测量 FastAPI_Param 里每种校验写法对单个请求的开销：
+
+- 吞吐（req/s）与延迟分位数（p50 / p90 / p99，单位微秒）
+- 单个请求的内存分配峰值（tracemalloc，单位 KiB）
+- 相对 "baseline"（无任何校验的路由）的额外耗时，校验通过与拒绝 (422) 分开统计
+
+用法（在 FastAPI_Param 目录下执行）：
+    python bench_param.py                      # 跑一遍并打印结果
+    python bench_param.py --save-baseline      # 把本次结果保存为基线
+    python bench_param.py --check              # 与基线对比，退化超过阈值时返回非 0 退出码
+    python bench_param.py --feature path-regex # 只跑某一种校验特性
+
+注意：基线与机器相关，请在同一台机器上生成和对比。
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+import warnings
+from pathlib import Path as LibPath
+
+import httpx
+
+# param_path.py / param_query.py 里使用了已弃用的 regex=，导入时会有警告，这里忽略掉
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    import param_field
+    import param_form
+    import param_path
+    import param_query
+    import pathParam
+    import queryParam
+    import request
+
+BASELINE_FILE = LibPath(__file__).resolve().parent / "bench_baseline.json"
+
+# 每个用例：(校验特性, app, 请求方法, 路径, 请求参数, 期望状态码)
+# 同一特性会同时覆盖“校验通过”和“校验失败 (422)”两种情况，失败分支往往更贵
+CASES = [
+    ("baseline", pathParam.app, "GET", "/args1/1", {}, 200),
+    ("path-str", pathParam.app, "GET", "/args2/abc", {}, 200),
+    ("path-int", param_path.app, "GET", "/item1/50", {}, 200),
+    ("path-int", param_path.app, "GET", "/item1/abc", {}, 422),
+    ("path-gt-lt", param_path.app, "GET", "/item3/50", {}, 200),
+    ("path-gt-lt", param_path.app, "GET", "/item3/5", {}, 422),
+    ("path-regex", param_path.app, "GET", "/item4/a12", {}, 200),
+    ("path-regex", param_path.app, "GET", "/item4/b12", {}, 422),
+    ("path-enum", param_path.app, "GET", "/item5/resnet", {}, 200),
+    ("path-enum", param_path.app, "GET", "/item5/vgg", {}, 422),
+    ("before-validator", param_path.app, "GET", "/item6/P-1", {}, 200),
+    ("before-validator", param_path.app, "GET", "/item6/X-1", {}, 422),
+    ("query-required", param_query.app, "GET", "/items2?item_id=abc", {}, 200),
+    ("query-length", param_query.app, "GET", "/items3?item_id=abcd", {}, 200),
+    ("query-length", param_query.app, "GET", "/items3?item_id=ab", {}, 422),
+    ("query-gt-lt", param_query.app, "GET", "/items4?item_id=50", {}, 200),
+    ("query-alias", param_query.app, "GET", "/items5?id=1", {}, 200),
+    ("query-regex", param_query.app, "GET", "/items8?item_id=a12", {}, 200),
+    ("query-regex", param_query.app, "GET", "/items8?item_id=b12", {}, 422),
+    ("query-untyped", queryParam.app, "GET", "/query3?page=1&limit=2&info=3", {}, 200),
+    ("body-model", request.app, "POST", "/items/", {"json": {"name": "a", "price": 1}}, 200),
+    ("field-gt-le", param_field.app, "POST", "/products/", {"json": {"price": 10}}, 200),
+    ("field-gt-le", param_field.app, "POST", "/products/", {"json": {"price": 1000}}, 422),
+    ("field-pattern", param_field.app, "POST", "/accounts/", {"json": {"username": "abcd", "password": "abcdefg"}}, 200),
+    ("field-validator", param_field.app, "POST", "/user2/", {"json": {"email": "a@b.c"}}, 200),
+    ("field-validator", param_field.app, "POST", "/user2/", {"json": {"email": "abc"}}, 422),
+    ("list-min-length", param_field.app, "POST", "/order/", {"json": {"items": list(range(10)), "address": "x"}}, 200),
+    ("list-min-length", param_field.app, "POST", "/order/", {"json": {"items": [1], "address": "x"}}, 422),
+    # /login1/ 的参数没有声明 Form()，实际按查询参数解析
+    ("post-query-fields", param_form.app, "POST", "/login1/?username=a&password=b", {}, 200),
+    ("form-model", param_form.app, "POST", "/login2/", {"data": {"username": "a", "password": "b"}}, 200),
+    ("form-model-bound", param_form.app, "POST", "/login3/", {"data": {"username": "a", "password": "b"}}, 200),
+]  # fmt: skip
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """最近秩法求分位数，输入必须已排序"""
+    index = min(
+        len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1)))
+    )
+    return sorted_values[index]
+
+
+async def run_case(app, method, path, kwargs, expected, iterations, warmup):
+    transport = httpx.ASGITransport(app=app)
+
+    def check(resp):
+        # 状态码不对说明测到的不是想测的分支（例如通过和拒绝混在一起），结果没有意义
+        if resp.status_code != expected:
+            raise RuntimeError(
+                f"{method} {path} 返回 {resp.status_code}，期望 {expected}"
+            )
+
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        # 1. 预热：让路由匹配、Pydantic 校验器等走完首次初始化
+        for _ in range(warmup):
+            check(await client.request(method, path, **kwargs))
+
+        # 2. 计时：逐个请求记录耗时（纳秒），状态码在停表之后再检查
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            t0 = time.perf_counter_ns()
+            resp = await client.request(method, path, **kwargs)
+            latencies.append((time.perf_counter_ns() - t0) / 1000)
+            check(resp)
+        elapsed = time.perf_counter() - started
+
+        # 3. 内存：单独跑一小轮并开启 tracemalloc（它本身会拖慢速度，不能和计时混在一起）
+        alloc_samples = []
+        tracemalloc.start()
+        for _ in range(min(iterations, 50)):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            await client.request(method, path, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+            alloc_samples.append((peak - current) / 1024)
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "rps": iterations / elapsed,
+        "p50_us": percentile(latencies, 50),
+        "p90_us": percentile(latencies, 90),
+        "p99_us": percentile(latencies, 99),
+        "alloc_kib": statistics.mean(alloc_samples),
+    }
+
+
+async def run_all(cases, iterations, warmup):
+    results = {}
+    for feature, app, method, path, kwargs, expected in cases:
+        key = f"{feature} {method} {path} [{expected}]"
+        results[key] = {"feature": feature, "expected": expected} | await run_case(
+            app, method, path, kwargs, expected, iterations, warmup
+        )
+    return results
+
+
+def summarize_features(results: dict) -> dict:
+    """
+    按 (校验特性, 期望状态码) 聚合：取同组用例 p50 的平均值，并与 baseline 对比。
+    通过 (200) 和拒绝 (422) 分开统计：拒绝分支要构造错误详情，两者混在一起求平均会掩盖真实开销
+    """
+    grouped = {}
+    for row in results.values():
+        grouped.setdefault((row["feature"], row["expected"]), []).append(row)
+
+    base = grouped.get(("baseline", 200))
+    base_p50 = statistics.mean(r["p50_us"] for r in base) if base else 0.0
+
+    summary = {}
+    for group, rows in grouped.items():
+        p50 = statistics.mean(r["p50_us"] for r in rows)
+        summary[group] = {
+            "p50_us": p50,
+            "overhead_us": p50 - base_p50,
+            "alloc_kib": statistics.mean(r["alloc_kib"] for r in rows),
+        }
+    return summary
+
+
+def print_report(results: dict, summary: dict):
+    print(f"{'endpoint':<58}{'req/s':>10}{'p50':>9}{'p90':>9}{'p99':>9}{'KiB':>8}")
+    for key, row in results.items():
+        print(
+            f"{key:<58}{row['rps']:>10.0f}{row['p50_us']:>9.1f}"
+            f"{row['p90_us']:>9.1f}{row['p99_us']:>9.1f}{row['alloc_kib']:>8.1f}"
+        )
+    print()
+    print(f"{'feature':<20}{'status':>8}{'p50(us)':>10}{'+vs base':>10}{'KiB':>8}")
+    for (feature, expected), row in summary.items():
+        print(
+            f"{feature:<20}{expected:>8}{row['p50_us']:>10.1f}"
+            f"{row['overhead_us']:>+10.1f}{row['alloc_kib']:>8.1f}"
+        )
+
+
+def check_baseline(results: dict, tolerance: float) -> list[str]:
+    """
+    与基线对比，返回退化项列表：
+    - 吞吐下降超过 tolerance
+    - 单请求内存峰值增长超过 tolerance
+    """
+    baseline = json.loads(BASELINE_FILE.read_text(encoding="utf-8"))
+    regressions = []
+    compared = 0
+    for key, row in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        compared += 1
+        if row["rps"] < old["rps"] * (1 - tolerance):
+            regressions.append(f"{key}: req/s {old['rps']:.0f} -> {row['rps']:.0f}")
+        if row["alloc_kib"] > old["alloc_kib"] * (1 + tolerance):
+            regressions.append(
+                f"{key}: KiB {old['alloc_kib']:.1f} -> {row['alloc_kib']:.1f}"
+            )
+    if compared == 0:
+        # 一个用例都没对比上，不能当作“没有退化”
+        regressions.append("基线中没有与本次运行匹配的用例，请重新执行 --save-baseline")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FastAPI_Param 校验开销微基准")
+    parser.add_argument("-n", "--iterations", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--feature", help="只运行指定的校验特性")
+    parser.add_argument("--save-baseline", action="store_true", help="保存为新的基线")
+    parser.add_argument("--check", action="store_true", help="与基线对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的退化比例")
+    args = parser.parse_args()
+
+    selected = [c for c in CASES if args.feature in (None, c[0])]
+    if not selected:
+        sys.exit(f"未知的校验特性: {args.feature}")
+    # 作为 CI 门禁时，没有基线必须失败，而不是什么都没比就报告“未发现性能退化”
+    if args.check and not args.save_baseline and not BASELINE_FILE.exists():
+        sys.exit(f"未找到基线文件 {BASELINE_FILE.name}，请先执行 --save-baseline")
+
+    results = asyncio.run(run_all(selected, args.iterations, args.warmup))
+    print_report(results, summarize_features(results))
+
+    if args.save_baseline:
+        BASELINE_FILE.write_text(
+            json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+        print(f"\n基线已保存到 {BASELINE_FILE.name}")
+
+    if args.check:
+        regressions = check_baseline(results, args.tolerance)
+        if regressions:
+            print("\n发现性能退化：")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("\n未发现性能退化")